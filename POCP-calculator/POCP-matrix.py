@@ -8,25 +8,53 @@ An elegant matrix table will be created after the calculation.
 The program was written based on (Qin et al. 2014; doi: 10.1128/JB.01688-14)
 
 # Required:
-BLAST+ installed in $PATH
+BLAST+ installed in $PATH (or DIAMOND, with --engine diamond)
 
 # Usage:
-$ python POCP-matrix.py -i input_dir -o output_matrix.tab [-n 8] [--clean]
+$ python POCP-matrix.py -i input_dir -o output_matrix.tab [-n 8] [-j 4] [--allvsall] [-s POCP.sqlite] [--engine diamond] [--prefilter 5] [--screen 60] [--npy matrix.npy] [--pairs pairs.tsv] [--summary run.json] [--clean]
 
 # Options:
 -i: input directory contained more than 2 translated genome files (suffix: .faa)
 -o: output POCP matrix file
 -n: number of threads (optional, default: 3)
+-j: number of genome pairs compared concurrently; the -n threads are shared among them (optional, default: 1)
+--allvsall: search all proteomes against one database in a single blastp run
+--max_target_seqs: max_target_seqs of the --allvsall search (optional, default: max(500, 10 * number of genomes))
+-s: SQLite file storing the conserved-protein counts of every genome pair, keyed on the
+    content of both proteome files; when given again, only the pairs of new or changed
+    genomes are compared (optional)
+--engine: search engine, blast or diamond (optional, default: blast)
+--diamond: path to the diamond executable (optional, default: diamond)
+--prefilter: only search the proteins sharing at least 2 k-mers of this length (3-5)
+    with the other proteome; a protein without any is taken as not conserved (optional)
+--screen: estimate the amino-acid identity of every pair from MinHash sketches of the
+    proteomes and only compute the POCP of pairs estimated at least this identity (%);
+    other cells hold the estimate, marked with '*' (optional)
+--screen_max: also skip the exact POCP of pairs estimated above this identity (%) (optional, default: 100)
+--npy: also write the matrix as a .npy file, with the genome names and the
+    cells estimated by --screen alongside (optional, requires numpy)
+--pairs: also write every genome pair in long format (optional)
+--summary: write a JSON summary of the run, with the search and parsing time of every pair (optional)
 --clean: blast output and databases created by this program will be removed (optional)
 
 """
 
-import sys, os, re
+import sys, os
 import glob
 import itertools
+import math
 from math import factorial # used to compute the progress
 import subprocess
 import argparse
+import shutil
+import heapq
+import zlib
+import json
+import time
+from array import array
+import hashlib
+import sqlite3
+from multiprocessing import Pool
 
 __author__ = "Heyu Lin"
 __contact__ = "heyu.lin@student.unimelb.edu.au"
@@ -42,10 +70,51 @@ parser.add_argument('-o', '--output', metavar='output_filename', dest='o',
 parser.add_argument('-n', '--num_threads', metavar='num_cpu',
     dest='n', type=int, default=3,
     help='specify the number of threads used by blast (default=3)')
+parser.add_argument('-j', '--jobs', metavar='num_jobs',
+    dest='j', type=int, default=1,
+    help='number of genome pairs compared concurrently, sharing the -n threads (default=1)')
+parser.add_argument('--allvsall', dest='allvsall',
+    action='store_true', default=False,
+    help='search all proteomes against one database in a single blastp run')
+parser.add_argument('--max_target_seqs', metavar='num_sequences',
+    dest='ms', type=int, default=0,
+    help='max_target_seqs of the --allvsall search (default=max(500, 10 * number of genomes))')
+parser.add_argument('-s', '--store', metavar='store_file',
+    dest='s', type=str, default=None,
+    help='SQLite file keeping the conserved-protein counts of every genome pair, '
+    'so that only the pairs of new or changed genomes are compared on later runs')
+parser.add_argument('--engine', metavar='engine',
+    dest='e', type=str, choices=['blast', 'diamond'], default='blast',
+    help='search engine: blast or diamond (default=blast)')
+parser.add_argument('--diamond', metavar='diamond_path',
+    dest='diamond', type=str, default='diamond',
+    help='path to the diamond executable (default=diamond)')
+parser.add_argument('--prefilter', metavar='kmer_size',
+    dest='prefilter', type=int, choices=[3, 4, 5], default=0,
+    help='only search the proteins sharing at least 2 k-mers of this size with the other proteome '
+    '(pairwise mode only)')
+parser.add_argument('--screen', metavar='min_identity',
+    dest='screen', type=float, default=None,
+    help='only compute the POCP of pairs whose identity estimated from MinHash sketches '
+    'is at least this value (%%); other cells hold the estimate, marked with "*"')
+parser.add_argument('--screen_max', metavar='max_identity',
+    dest='screen_max', type=float, default=100,
+    help='also skip the POCP of pairs estimated above this identity (%%) (default=100)')
+parser.add_argument('--npy', metavar='npy_file',
+    dest='npy', type=str, default=None,
+    help='also write the matrix as a .npy file, with the genome names and the cells estimated by --screen alongside (requires numpy)')
+parser.add_argument('--pairs', metavar='pairs_file',
+    dest='pairs', type=str, default=None,
+    help='also write every genome pair in long format')
+parser.add_argument('--summary', metavar='summary_file',
+    dest='summary', type=str, default=None,
+    help='write a JSON summary of the run, with the search and parsing time of every pair')
 parser.add_argument('--clean', metavar='clean_blast_db_output',
     dest='c', nargs="?", const=True, default=False,
     help='redundant files created by this program will be removed if this argument is added')
 args=parser.parse_args()
+if args.prefilter and args.allvsall:
+    parser.error('--prefilter only applies to the pairwise mode')
 
 """
 Define functions
@@ -97,100 +166,668 @@ def run_blastp(q, db, o, n):
     except Exception as e:
         raise e
 
-def num_sequnces(fasta):
-	pattern = r"^>"
-	with open(fasta, "r") as f:
-		data = f.read()
-		iterator = re.finditer(pattern, data, re.MULTILINE)
-		count = 0
-		for match in iterator:
-			count += 1
-		return count
+DIAMOND_OUTFMT = ['6', 'qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',
+    'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore', 'qlen'] # Same columns as "6 std qlen"
+
+def run_mkdiamonddb(fi, fo):
+    """
+    fi: input fasta file
+    fo: output database name
+    """
+    cmd_para = [
+                args.diamond, 'makedb',
+                '--in', fi,
+                '--db', fo,
+                '--quiet',
+                ]
+    subprocess.call(cmd_para, stdout=subprocess.PIPE)
+
+def run_diamond(q, db, o, n):
+    """
+    q: query
+    db: database
+    o: output
+    n: num_cpu
+    """
+    cmd_para = [
+                args.diamond, 'blastp',
+                '--query', q,
+                '--out', o,
+                '--db', db,
+                '--evalue', '1e-5',
+                '--outfmt'] + DIAMOND_OUTFMT + [
+                '--max-target-seqs', '1',
+                '--threads', str(n),
+                '--quiet',
+                ]
+    process = subprocess.Popen(cmd_para, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    for warning in stderr.decode("utf-8").split('\n'):
+        if warning != '':
+            print("Warning:", warning)
+
+"""
+Search engines: database builder, one-to-one search writing to a file,
+and command of the all-vs-all search streamed to the parser
+"""
+def blastp_allvsall_cmd(q, db, n, ms, dbsize):
+	return ['blastp', '-query', q, '-db', db, '-evalue', '1e-5',
+		'-outfmt', "6 std qlen", '-max_target_seqs', str(ms),
+		'-dbsize', str(dbsize), '-num_threads', str(n)]
+
+def diamond_allvsall_cmd(q, db, n, ms, dbsize):
+	return [args.diamond, 'blastp', '--query', q, '--db', db, '--evalue', '1e-5',
+		'--outfmt'] + DIAMOND_OUTFMT + ['--max-target-seqs', str(ms),
+		'--dbsize', str(dbsize), '--threads', str(n), '--quiet']
+
+ENGINES = {
+	'blast': (run_mkblastdb, run_blastp, blastp_allvsall_cmd),
+	'diamond': (run_mkdiamonddb, run_diamond, diamond_allvsall_cmd),
+}
+
+def search_tag():
+	"""
+	Name of the search settings, which tells apart their results
+	in the store and in the names of the output files
+	"""
+	tag = 'blastp' if args.e == 'blast' else 'diamond'
+	if args.prefilter:
+		tag += '.k{}'.format(args.prefilter)
+	return tag
+
+def read_cache(cache_file, fasta, digest=None):
+	"""
+	Return the lines cached for the fasta by write_cache, or None if stale.
+	digest: SHA-1 of the fasta, known with -s; the cache must then have been
+	written for this content, since a replaced file may keep an older mtime.
+	Otherwise the cache is used as long as it is newer than the fasta.
+	"""
+	if not os.path.exists(cache_file):
+		return None
+	with open(cache_file, 'r') as f:
+		lines = f.read().split('\n')
+	if not lines[0].startswith('sha1:'):
+		return None # Written by a former version
+	if digest is not None:
+		return lines[1:] if lines[0] == 'sha1:' + digest else None
+	if os.path.getmtime(cache_file) >= os.path.getmtime(fasta):
+		return lines[1:]
+	return None
+
+def write_cache(cache_file, digest, lines):
+	with open(cache_file, 'w') as f:
+		f.write('\n'.join(['sha1:' + (digest or '')] + lines))
+
+def num_sequnces(fasta, digest=None):
+	"""
+	Count the proteins of a genome once, caching the count alongside its
+	blast database (see read_cache)
+	"""
+	count_file = fasta + '_POCP.count'
+	cached = read_cache(count_file, fasta, digest)
+	if cached:
+		return int(cached[0])
+	count = 0
+	with open(fasta, 'r') as f:
+		for line in f:
+			if line.startswith('>'):
+				count += 1
+	write_cache(count_file, digest, [str(count)])
+	return count
+
+def concat_proteomes(genomes, fo, subset=None):
+	"""
+	Write all proteomes into one fasta file, renaming every protein to
+	g<genome>_<protein> so that its genome is known from its ID
+	and no header is too long for makeblastdb.
+	subset: ordinals of the genomes to write (default: all)
+	return the number of proteins of every genome and the number of residues
+	"""
+	num_prot = [0] * len(genomes)
+	num_res = 0
+	with open(fo, 'w') as out:
+		for g, genome in enumerate(genomes):
+			if subset is not None and g not in subset:
+				continue
+			with open(genome, 'r') as f:
+				for line in f:
+					if line.startswith('>'):
+						out.write('>g{}_{}\n'.format(g, num_prot[g]))
+						num_prot[g] += 1
+					else:
+						num_res += len(line.strip())
+						out.write(line)
+	return num_prot, num_res
+
+def run_allvsall(q, db, n, ms, dbsize, timing=None):
+	"""
+	q: query (all proteomes)
+	db: database built from the same proteomes
+	n: num_cpu
+	ms: max_target_seqs
+	dbsize: effective database length, the mean proteome length, so that
+		evalues stay comparable to those of one genome against another
+	timing: dict whose 'search' is increased by the time spent waiting for the engine
+	Yield the output lines as the search engine writes them.
+	"""
+	cmd_para = ENGINES[args.e][2](q, db, n, ms, dbsize)
+	process = subprocess.Popen(cmd_para, stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL, universal_newlines=True)
+	waited = 0.0
+	start = time.perf_counter()
+	for line in process.stdout:
+		waited += time.perf_counter() - start
+		yield line
+		start = time.perf_counter()
+	process.stdout.close()
+	if timing is not None:
+		timing['search'] = timing.get('search', 0.0) + waited + time.perf_counter() - start
+	if process.wait():
+		raise RuntimeError('{} exited with status {}'.format(cmd_para[0], process.returncode))
+
+def allvsall_counts(lines, num_genomes, total=0):
+	"""
+	Count, for every ordered genome pair (a, b), the proteins of a whose best
+	hit in b is conserved (identity >= 40% and query coverage >= 50%).
+	As with one blastp per pair and -max_target_seqs 1, only the HSPs of the
+	best subject of each target genome are considered.
+	total: number of proteins, to report the progress
+	"""
+	counts = [[0] * num_genomes for _ in range(num_genomes)]
+	qury_temp = ''
+	best = {} # target genome -> best subject of the current query
+	counted = set() # target genomes in which the current query is conserved
+	processed = 0
+	for line in lines:
+		items = line.split()
+		qury, subj = items[0], items[1]
+		if qury != qury_temp:
+			processed += 1
+			if total and processed % 100 == 0:
+				print("\r{}/{} proteins searched".format(processed, total), end='')
+				sys.stdout.flush()
+			qury_temp = qury
+			qury_genome = int(qury[1:qury.index('_')])
+			best = {}
+			counted = set()
+		subj_genome = int(subj[1:subj.index('_')])
+		if subj_genome == qury_genome or subj_genome in counted:
+			continue
+		if best.setdefault(subj_genome, subj) != subj:
+			continue # not the best subject of this genome
+		iden = float(items[2])
+		qcov = float(items[3]) / float(items[12])
+		if iden >= 40 and qcov >= 0.5:
+			counts[qury_genome][subj_genome] += 1
+			counted.add(subj_genome)
+	return counts
+
+def allvsall_hits(genomes, num_cpu, todo):
+	"""
+	Compare the genomes of the pairs in todo with at most two blastp runs:
+	those genomes against all the proteomes, then the other genomes against
+	those only, so that pairs of two other genomes are not searched again.
+	Return the conserved-protein counts of every ordered genome pair searched,
+	and the time spent searching and parsing in every blastp run
+	"""
+	new = set(itertools.chain.from_iterable(todo))
+	old = set(range(len(genomes))) - new
+	all_faa = os.path.join(args.i, 'POCP_allvsall.fasta')
+	num_prot, num_res = concat_proteomes(genomes, all_faa)
+	make_db = ENGINES[args.e][0]
+	make_db(all_faa, all_faa + '_POCP')
+	ms = args.ms or max(500, 10 * len(genomes))
+	dbsize = max(num_res // len(genomes), 1)
+	if old:
+		new_faa = os.path.join(args.i, 'POCP_allvsall.new.fasta')
+		old_faa = os.path.join(args.i, 'POCP_allvsall.old.fasta')
+		concat_proteomes(genomes, new_faa, new)
+		concat_proteomes(genomes, old_faa, old)
+		make_db(new_faa, new_faa + '_POCP')
+		searches = [(new_faa, new, all_faa, set(range(len(genomes)))), (old_faa, old, new_faa, new)]
+	else:
+		searches = [(all_faa, new, all_faa, new)]
+	hits = {}
+	timings = []
+	for query, query_genomes, db, db_genomes in searches:
+		timing = {'query_genomes': len(query_genomes), 'db_genomes': len(db_genomes)}
+		start = time.perf_counter()
+		lines = run_allvsall(query, db + '_POCP', num_cpu, ms, dbsize, timing)
+		counts = allvsall_counts(lines, len(genomes), sum(num_prot[g] for g in query_genomes))
+		timing['parse'] = time.perf_counter() - start - timing['search']
+		timings.append(timing)
+		for a in query_genomes:
+			for b in db_genomes:
+				if a != b:
+					hits[(a, b)] = counts[a][b]
+	return hits, timings
+
+SKETCH_K = 9 # Amino-acid k-mer size of the MinHash sketches, as for Mash
+SKETCH_SIZE = 1000 # Number of the smallest hashes kept per proteome
+
+def proteome_sketch(fasta, digest=None):
+	"""
+	Bottom-k MinHash sketch of the amino-acid k-mers of a proteome: the
+	SKETCH_SIZE smallest CRC32 hashes, sorted. It is computed once and cached
+	alongside the blast database (see read_cache).
+	"""
+	sketch_file = fasta + '_POCP.sketch'
+	cached = read_cache(sketch_file, fasta, digest)
+	if cached is not None:
+		return [int(h) for h in cached if h]
+	hashes = set()
+	for _, seq in read_fasta(fasta):
+		seq = seq.upper().encode('ascii', 'replace')
+		for i in range(len(seq) - SKETCH_K + 1):
+			hashes.add(zlib.crc32(seq[i:i+SKETCH_K]))
+	sketch = heapq.nsmallest(SKETCH_SIZE, hashes)
+	write_cache(sketch_file, digest, list(map(str, sketch)))
+	return sketch
+
+def sketch_identity(a, b):
+	"""
+	Estimate the amino-acid identity (%) of two proteomes from their sketches:
+	the Jaccard index j of their k-mers, from the bottom hashes of the union,
+	turned into the Mash distance -ln(2j / (1 + j)) / k
+	"""
+	shared = 0
+	union = 0
+	i = j = 0
+	while union < SKETCH_SIZE and i < len(a) and j < len(b):
+		if a[i] == b[j]:
+			shared += 1
+			i += 1
+			j += 1
+		elif a[i] < b[j]:
+			i += 1
+		else:
+			j += 1
+		union += 1
+	union += min(SKETCH_SIZE - union, len(a) - i + len(b) - j)
+	if shared == 0:
+		return 0.0
+	jaccard = shared / union
+	dist = -math.log(2 * jaccard / (1 + jaccard)) / SKETCH_K
+	return max(0.0, 1 - dist) * 100
 
 def comb(n, r):
 	return factorial(n) // factorial(r) // factorial(n-r)
 
-def POCP_calculator(pair, num_cpu):
-	T1 = num_sequnces(pair[0])
-	T2 = num_sequnces(pair[1])
-	blastout_name1 = pair[0] + '--' + os.path.basename(pair[1]) + '.POCPout'
-	if not os.path.exists(blastout_name1):
-		run_blastp(pair[0], pair[1]+'_POCP', blastout_name1, num_cpu)
-	blastout_name2 = pair[1] + '--' + os.path.basename(pair[0]) + '.POCPout'
-	if not os.path.exists(blastout_name2):
-		run_blastp(pair[1], pair[0]+'_POCP', blastout_name2, num_cpu)
+def pair_hits(pair, num_cpu):
+	"""
+	Return the number of proteins of each genome of the pair
+	that are conserved in the other one, and the time spent
+	searching (0 if the output was reused) and parsing
+	"""
+	tag = search_tag()
+	suffix = '.POCPout' if tag == 'blastp' else '.' + tag + '.POCPout'
+	hits = []
+	timing = {'search': 0.0, 'parse': 0.0}
+	for query, subject in [pair, pair[::-1]]:
+		blastout_name = query + '--' + os.path.basename(subject) + suffix
+		start = time.perf_counter()
+		if not output_reusable(blastout_name, query, subject):
+			search(query, subject, blastout_name, num_cpu)
+		timing['search'] += time.perf_counter() - start
+		start = time.perf_counter()
+		hits.append(count_hits(blastout_name))
+		timing['parse'] += time.perf_counter() - start
+	return tuple(hits), timing
+
+def output_reusable(o, query, subject):
+	"""
+	An output left by a former run is reused only if it is newer than both
+	proteomes, and never with -s: the store is keyed on the proteome contents,
+	which an output named after the files cannot tell apart
+	"""
+	if args.s or not os.path.exists(o):
+		return False
+	mtime = os.path.getmtime(o)
+	return mtime >= os.path.getmtime(query) and mtime >= os.path.getmtime(subject)
+
+def search(query, subject, o, num_cpu):
+	"""
+	Search the proteins of query against the database of subject, first
+	dropping those without enough shared k-mers if --prefilter is set
+	"""
+	if args.prefilter:
+		fo = o[:-len('.POCPout')] + '.POCPquery'
+		prefilter_query(query, subject, args.prefilter, fo)
+		ENGINES[args.e][1](fo, subject+'_POCP', o, num_cpu)
+		os.remove(fo)
+	else:
+		ENGINES[args.e][1](query, subject+'_POCP', o, num_cpu)
+
+PREFILTER_MIN_SHARED = 2 # k-mers a protein has to share with the other proteome
+KMER_TABLE = bytes.maketrans(b'ACDEFGHIKLMNPQRSTVWYacdefghiklmnpqrstvwy',
+	bytes(range(20)) * 2) # other bytes are left >= 20 and mapped to 20 below
+
+def read_fasta(fi):
+	"""
+	Yield the header line and the sequence of every record
+	"""
+	header, seq = None, []
+	with open(fi, 'r') as f:
+		for line in f:
+			if line.startswith('>'):
+				if header is not None:
+					yield header, ''.join(seq)
+				header, seq = line, []
+			else:
+				seq.append(line.strip())
+	if header is not None:
+		yield header, ''.join(seq)
+
+def kmer_codes(seq, k):
+	"""
+	Yield the code of every k-mer of seq, in base 21
+	"""
+	size = 21 ** k
+	code = 0
+	for i, c in enumerate(seq.encode('ascii', 'replace').translate(KMER_TABLE)):
+		code = (code * 21 + min(c, 20)) % size
+		if i >= k - 1:
+			yield code
+
+def prefilter_query(q, subject, k, fo):
+	"""
+	Write to fo the proteins of q sharing at least PREFILTER_MIN_SHARED
+	k-mers with the proteome subject, and return their number.
+	The k-mers of subject are kept in a bitmap of 21^k bytes (4 MB for k = 5).
+	This is lossy: a conserved protein without any shared k-mer is dropped,
+	which gets less likely as k decreases.
+	"""
+	seen = bytearray(21 ** k)
+	for _, seq in read_fasta(subject):
+		for code in kmer_codes(seq, k):
+			seen[code] = 1
+	kept = 0
+	with open(fo, 'w') as out:
+		for header, seq in read_fasta(q):
+			shared = 0
+			for code in kmer_codes(seq, k):
+				shared += seen[code]
+				if shared >= PREFILTER_MIN_SHARED:
+					out.write(header + seq + '\n')
+					kept += 1
+					break
+	return kept
+
+def count_hits(outfile):
+	"""
+	Count the queries having at least one eligible hit region
+	(identity >= 40% and query coverage >= 50%), streaming the blast output.
+	A query is counted only once, even if it has several eligible regions,
+	and its remaining lines are skipped without being parsed. Any region
+	of a query may be the eligible one, not only the first.
+	"""
 	hit_sum = 0 # Initialize the number of hit sequences
-	for outfile in [blastout_name1, blastout_name2]:
-		with open(outfile, 'r') as f:
-			"""
-			qury_temp: used to test whether a query has only one hit region
-			recd: In the case that a query has more than on alignabe region,
-				only one hit that eligible should be count
-			"""
-			qury_temp = 'temp'
-			recd = False
-			for line in f.readlines():
-				items = line.split()
-				qury = items[0]
-				iden = float(items[2])
-				qcov = float(items[3]) / float(items[12])
-				if qury != qury_temp and iden >= 40 and qcov >= 0.5:
-					hit_sum += 1
-					recd = True # This query has been counted, and should not be
-								# counted again if it has another eligible regions
-				elif qury == qury_temp and iden >= 40 and qcov >= 0.5:
-					if recd == False: # Although the sequence has two hit region,
-									# the previous regions were not eligible
-						hit_sum += 1
-						recd = True
-				qury_temp = qury
-	return hit_sum/(T1 + T2) * 100
-
-def output_table(dict, items, out):
+	counted = None # The last query counted
+	with open(outfile, 'r') as f:
+		for line in f:
+			qury = line.split(None, 1)[0]
+			if qury == counted:
+				continue
+			items = line.split()
+			if float(items[2]) >= 40 and float(items[3]) >= 0.5 * float(items[12]):
+				hit_sum += 1
+				counted = qury
+	return hit_sum
+
+def POCP_job(ordinals, pair, num_cpu):
+	"""
+	Run in a worker process, return the ordinals of the pair along with its
+	conserved-protein counts so that results can be collected in any order
+	"""
+	return (ordinals,) + pair_hits(pair, num_cpu)
+
+def POCP_job_star(para):
+	return POCP_job(*para)
+
+def output_table(matrix, estimated, items, out):
+	"""
+	matrix: POCP values, a flat array indexed by genome ordinals
+		(row * number of genomes + column), NaN if not computed
+	estimated: 1 for the values estimated by --screen, indexed alike
+	Write the lower triangle, a row at a time
+	"""
+	num = len(items)
 	with open(out, 'w') as fo:
 		fo.write('POCP' + "\t" + "\t".join(items) + "\n")
-		num = len(items)
-		for i in range(len(items)):
-			lst = []
-			lst.append(os.path.basename(items[i]))
-			for j in range(len(items)):
-				if items[i] == items[j]:
-					lst.append('100')
+		for i in range(num):
+			lst = [items[i]]
+			for k in range(i * num, i * num + i):
+				value = matrix[k]
+				if value != value: # NaN
+					lst.append('~')
 				else:
-					lst.append(str(dict.get((items[j],items[i]), '~')))
+					lst.append(str(value) + ('*' if estimated[k] else ''))
+			lst.append('100')
+			lst.extend(['~'] * (num - i - 1))
 			fo.write("\t".join(lst) + "\n")
 
+def output_npy(matrix, estimated, items, out):
+	"""
+	Write the matrix as a float64 .npy file, which can be opened with
+	np.load(out, mmap_mode='r'), the genome names one per line alongside,
+	and a bool matrix marking the values estimated by --screen
+	"""
+	import numpy as np
+	num = len(items)
+	# np.save would append .npy to a name without it, so the files are opened here
+	with open(out, 'wb') as fo:
+		np.save(fo, np.frombuffer(matrix, dtype=np.float64).reshape(num, num))
+	with open(out + '.estimated.npy', 'wb') as fo:
+		np.save(fo, np.frombuffer(estimated, dtype=np.bool_).reshape(num, num))
+	with open(out + '.ids.txt', 'w') as fo:
+		fo.write('\n'.join(items) + '\n')
+
+def output_pairs(matrix, estimated, items, out):
+	"""
+	Write every genome pair with a value in long format
+	"""
+	num = len(items)
+	with open(out, 'w') as fo:
+		fo.write('genome1\tgenome2\tPOCP\tmethod\n')
+		for i, j in itertools.combinations(range(num), 2):
+			value = matrix[i * num + j]
+			if value == value:
+				method = 'estimated' if estimated[i * num + j] else 'exact'
+				fo.write('{}\t{}\t{}\t{}\n'.format(items[i], items[j], value, method))
+
 def clean(pth):
 	for file in glob.iglob(os.path.join(pth,'*_POCP.p??')):
 		os.remove(file) # Clean blast databases
+	for file in glob.iglob(os.path.join(pth,'*_POCP.dmnd')):
+		os.remove(file) # Clean diamond databases
+	for file in glob.iglob(os.path.join(pth,'*_POCP.count')):
+		os.remove(file) # Clean protein counts
+	for file in glob.iglob(os.path.join(pth,'*_POCP.sketch')):
+		os.remove(file) # Clean MinHash sketches
 	for file in glob.iglob(os.path.join(pth,'*.POCPout')):
 		os.remove(file) # Clean blast output files
+	for file in glob.iglob(os.path.join(pth,'*.POCPquery')):
+		os.remove(file) # Clean prefiltered queries
+	for file in glob.iglob(os.path.join(pth,'POCP_allvsall*.fasta')):
+		os.remove(file) # Clean concatenated proteomes
+
+def pairwise_hits(genomes, todo):
+	"""
+	Run blastp between the two genomes of every pair in todo, in both directions
+	Return the conserved-protein counts of every ordered genome pair searched,
+	and the time spent searching and parsing for every pair
+	"""
+	num_blastp = len(todo) * 2 # The number of blastp should be called
+	# Split the threads among concurrent jobs, each blastp getting at least one
+	num_jobs = max(1, min(args.j, args.n))
+	threads_per_job = max(1, args.n // num_jobs)
+	pool = Pool(num_jobs)
+	# Make blast database for the genomes to compare
+	needed = sorted(set(itertools.chain.from_iterable(todo)))
+	pool.starmap(ENGINES[args.e][0], [(genomes[g], genomes[g]+'_POCP') for g in needed])
+	# Run blastp between every two genomes
+	hits = {}
+	timings = []
+	processed = 0
+	jobs = [((i, j), (genomes[i], genomes[j]), threads_per_job) for i, j in todo]
+	# Results are collected by this process as they come, so the progress stays in order
+	for (i, j), (hits_ij, hits_ji), timing in pool.imap_unordered(POCP_job_star, jobs):
+		hits[(i, j)] = hits_ij
+		hits[(j, i)] = hits_ji
+		timing['genomes'] = [os.path.basename(genomes[i]), os.path.basename(genomes[j])]
+		timings.append(timing)
+		processed += 2
+		processed_perc = round(processed/num_blastp * 30)
+		print("\r"+"["+">"*processed_perc+"]",
+			"{}/{}".format(processed, num_blastp),end='') # print progress bar
+		sys.stdout.flush()
+	pool.close()
+	pool.join()
+	return hits, timings
+
+def file_hash(fi):
+	h = hashlib.sha1()
+	with open(fi, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+class POCPStore:
+	"""
+	Persistent conserved-protein counts of every ordered genome pair and protein
+	counts of every genome, keyed on the SHA-1 of the proteome files, so that
+	adding genomes to a matrix only compares the new pairs. A changed proteome
+	file gets a new key, which invalidates only the pairs it is part of.
+	"""
+	def __init__(self, path, genomes, params):
+		self.conn = sqlite3.connect(path, timeout=600)
+		self.conn.execute('CREATE TABLE IF NOT EXISTS proteomes ('
+			'hash TEXT PRIMARY KEY, proteins INTEGER)')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS hits ('
+			'qhash TEXT, shash TEXT, params TEXT, hits INTEGER, '
+			'PRIMARY KEY (qhash, shash, params))')
+		self.conn.commit()
+		self.hashes = [file_hash(genome) for genome in genomes]
+		self.params = params
+
+	def load(self):
+		"""
+		Return the stored counts of the current genomes, by genome ordinal:
+		the conserved proteins of every ordered pair, and the proteins of
+		every genome (None if unknown)
+		"""
+		cur = self.conn.cursor()
+		cur.execute('CREATE TEMP TABLE cur (hash TEXT, idx INTEGER)')
+		cur.executemany('INSERT INTO cur VALUES (?, ?)', ((h, i) for i, h in enumerate(self.hashes)))
+		cur.execute('SELECT q.idx, s.idx, hits.hits FROM hits '
+			'JOIN cur AS q ON hits.qhash = q.hash JOIN cur AS s ON hits.shash = s.hash '
+			'WHERE hits.params = ? AND q.idx != s.idx', (self.params,))
+		hits = {(i, j): n for i, j, n in cur}
+		num_prot = [None] * len(self.hashes)
+		cur.execute('SELECT cur.idx, proteomes.proteins FROM proteomes '
+			'JOIN cur ON proteomes.hash = cur.hash')
+		for i, n in cur:
+			num_prot[i] = n
+		cur.execute('DROP TABLE cur')
+		return hits, num_prot
+
+	def add(self, hits, num_prot):
+		self.conn.executemany('INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)',
+			((self.hashes[i], self.hashes[j], self.params, n) for (i, j), n in hits.items()))
+		self.conn.executemany('INSERT OR REPLACE INTO proteomes VALUES (?, ?)',
+			((self.hashes[i], n) for i, n in enumerate(num_prot)))
+		self.conn.commit()
+
+	def close(self):
+		self.conn.close()
 
 """
 Main Program
 """
 def main():
+	run_start = time.perf_counter()
+	stages = {}
 	genomes = glob.glob(os.path.join(args.i,'*.faa'))
 	genomes_bn = list(map(os.path.basename, genomes))
 	num_genomes = len(genomes)
 	print(num_genomes, 'genomes have been read.')
-	num_blastp = comb(num_genomes,2) * 2 # The number of blastp should be called
-	# Make blast database for all the genomes
-	for genome in genomes:
-		run_mkblastdb(genome, genome+'_POCP')
-	# Run blastp between every two genomes
-	dict = {}
-	processed = 0
-	for genome_pair in itertools.combinations(genomes,2):
-		genome_pair_bn = tuple(map(os.path.basename, genome_pair))
-		POCP_value = POCP_calculator(genome_pair, args.n)
-		dict[genome_pair_bn] = POCP_value
-		processed += 2
-		processed_perc = round(processed/num_blastp * 30)
-		print("\r"+"["+">"*processed_perc+"]",
-			"{}/{}".format(processed, num_blastp),end='') # print progress bar
-		sys.stdout.flush()
-	output_table(dict, genomes_bn, args.o)
+	if args.e == 'diamond' and shutil.which(args.diamond) is None:
+		print('Warning: {} was not found, blast is used instead.'.format(args.diamond))
+		args.e = 'blast'
+	start = time.perf_counter()
+	store = POCPStore(args.s, genomes, search_tag() + '|1e-5') if args.s else None
+	if store:
+		hits, num_prot = store.load()
+	else:
+		hits, num_prot = {}, [None] * num_genomes
+	# Caches are keyed on the content of the proteomes when it is hashed for the store
+	digests = store.hashes if store else [None] * num_genomes
+	num_prot = [n if n is not None else num_sequnces(genome, digest)
+		for n, genome, digest in zip(num_prot, genomes, digests)]
+	stages['read'] = time.perf_counter() - start
+	# Only the pairs missing a direction have to be compared
+	todo = [(i, j) for i, j in itertools.combinations(range(num_genomes), 2)
+		if (i, j) not in hits or (j, i) not in hits]
+	num_stored = comb(num_genomes, 2) - len(todo)
+	if store:
+		print(num_stored, 'genome pairs were found in the store.')
+	estimates = {}
+	if args.screen is not None and todo:
+		# Pairs estimated out of the range are not compared, and keep their estimate
+		start = time.perf_counter()
+		sketches = [proteome_sketch(genome, digest) for genome, digest in zip(genomes, digests)]
+		for i, j in todo:
+			identity = sketch_identity(sketches[i], sketches[j])
+			if not args.screen <= identity <= args.screen_max:
+				estimates[(i, j)] = round(identity, 2)
+		todo = [pair for pair in todo if pair not in estimates]
+		stages['screen'] = time.perf_counter() - start
+		print(len(estimates), 'genome pairs were screened out by their estimated identity.')
+	timings = []
+	if todo:
+		start = time.perf_counter()
+		if args.allvsall:
+			new_hits, timings = allvsall_hits(genomes, args.n, todo)
+		else:
+			new_hits, timings = pairwise_hits(genomes, todo)
+		hits.update(new_hits)
+		stages['compare'] = time.perf_counter() - start
+	if store:
+		store.add(hits, num_prot)
+		store.close()
+	# Symmetric matrix of the POCP values, indexed by genome ordinals
+	start = time.perf_counter()
+	matrix = array('d', [float('nan')]) * (num_genomes * num_genomes)
+	estimated = bytearray(num_genomes * num_genomes)
+	for i, j in itertools.combinations(range(num_genomes), 2):
+		if (i, j) in estimates:
+			value = estimates[(i, j)]
+			estimated[i * num_genomes + j] = estimated[j * num_genomes + i] = 1
+		else:
+			value = (hits[(i, j)] + hits[(j, i)]) / (num_prot[i] + num_prot[j]) * 100
+		matrix[i * num_genomes + j] = matrix[j * num_genomes + i] = value
+	for i in range(num_genomes):
+		matrix[i * num_genomes + i] = 100
+	output_table(matrix, estimated, genomes_bn, args.o)
+	if args.npy:
+		output_npy(matrix, estimated, genomes_bn, args.npy)
+	if args.pairs:
+		output_pairs(matrix, estimated, genomes_bn, args.pairs)
+	stages['write'] = time.perf_counter() - start
+	if args.summary:
+		summary = {
+			'genomes': num_genomes,
+			'engine': search_tag(),
+			'mode': 'allvsall' if args.allvsall else 'pairwise',
+			'pairs': {'total': comb(num_genomes, 2), 'stored': num_stored,
+				'estimated': len(estimates), 'compared': len(todo)},
+			'seconds': dict(stages, total=time.perf_counter() - run_start),
+			'search_seconds': sum(t['search'] for t in timings),
+			'parse_seconds': sum(t['parse'] for t in timings),
+			'searches': timings,
+		}
+		with open(args.summary, 'w') as fo:
+			json.dump(summary, fo, indent=1)
 	if args.c == True:
 		clean(args.i)
 	print("\ndone.")
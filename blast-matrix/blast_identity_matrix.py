@@ -5,19 +5,44 @@ This script calculates pair-wise sequence identities for all sequences in a mult
 A matrix table will be generated after the calculation, and a clustered heatmap will be drawn if required.
 
 # Required:
-- BLAST+ installed in $PATH
+- BLAST+ installed in $PATH (not needed by the native engine)
 - Biopython (with pandas > 0.21)
 - seaborn & scipy (for drawing clustered heatmap)
 
 # Usage:
-$ python blast_identity_matrix.py -i input_seqs.fasta [-o output_matrix.tsv] [--heatmap output_heatmap.pdf] [--thread 4] [--program blastp] [--clean]
+$ python blast_identity_matrix.py -i input_seqs.fasta [-o output_matrix.tsv] [--heatmap output_heatmap.pdf] [--thread 4] [--program blastp] [--engine allvsall] [--clean]
 
 # Options:
 -i: Input file in multi-sequence FASTA format
--o: Output matrix table in tab-delimited format [default: (input file name) + '_ident.tsv']
+-o: Output matrix table in tab-delimited format [default: (input file name) + '_ident.' + (format)]
+-f: Format of the output matrix [default: tsv]
+    tsv: tab-delimited table
+    npy: NumPy float32 array, which can be memory-mapped, with the sequence IDs in (output) + '.ids.txt'
+    h5: HDF5 file (h5py required) with a chunked 'matrix' dataset and an 'ids' dataset
+--pairs: Also write the pairs reaching --pairs_min in long format (query, target, value),
+    as tab-delimited text or, if the file name ends with '.parquet', as Parquet (pyarrow required)
+--pairs_min: Minimum value of the pairs written to --pairs [default: 0]
 -t: Threads that would be used for makeblastdb and blast [default: 2]
 -p: blast program that would be used (blastp or blastn) [default: blastp]
+-e: search engine, 'pairwise' (one blast per sequence pair), 'allvsall' (a single multithreaded blast of all sequences against one database)
+    or 'native' (in-process alignment without BLAST, for short amplicons and small protein families) [default: pairwise]
+--align: alignment used by the native engine, global or local [default: global]
+--band: band width used by the native engine, 0 for a full alignment [default: 0]
+--metric: Value that fills the matrix [default: pident]
+    pident: identity of the best HSP
+    wident: identity of all HSPs of a pair, weighted by their alignment length
+    af: fraction of the query covered by the HSPs (%)
+    bitscore: sum of the bitscores of all HSPs of a pair (blast engines only)
+--symmetric: Search every pair in one direction only (pairwise engine) and make the matrix symmetric.
+    When both directions are available (allvsall engine) they are reconciled by max, mean or qlen [default policy: max]
+--cache: Keep the identity of every pair in this directory, keyed on the sequences and search parameters,
+    so that an interrupted job resumes and added sequences only compute their own pairs.
+--cache_size: Evict the least recently used pairs when the cache grows beyond this size in MB [default: unlimited]
+--memmap: Keep the matrix in a memory-mapped file in the temporary folder instead of RAM, for very large inputs. [default: False]
 --heatmap: Draw clustered heatmap.
+--heatmap_max: Above this number of sequences, the heatmap is drawn from cluster representatives
+    with a linkage computed on a condensed float32 distance vector, rasterised, and the ordering of
+    every sequence is written to (heatmap) + '.order.tsv' [default: 2000]
 --clean: Clean temporary files. [default: False]
 """
 
@@ -26,8 +51,12 @@ from Bio import SeqIO
 import argparse
 import random
 import shutil
-from itertools import permutations
-import pandas as pd
+import hashlib
+import sqlite3
+import time
+from itertools import combinations, permutations
+import numpy as np
+import pandas as pd  # only used to hand the matrix to seaborn
 import subprocess
 from multiprocessing import Pool
 
@@ -42,22 +71,69 @@ parser.add_argument('-i', '--input', metavar='input_fasta_file', dest='i',
 parser.add_argument('-o', '--output', metavar='output_table', dest='o',
                     type=str, required=False,
                     help='Output matrix table in tab-delimited format')
+parser.add_argument('-f', '--format', metavar='format', dest='f',
+                    type=str, required=False, default='tsv',
+                    choices=['tsv', 'npy', 'h5'],
+                    help='Format of the output matrix: tsv, npy (with IDs alongside) or h5. Default: tsv')
+parser.add_argument('--pairs', metavar='pairs_file', dest='pairs',
+                    type=str, required=False,
+                    help='Also write the pairs reaching --pairs_min in long format (tsv, or Parquet for *.parquet)')
+parser.add_argument('--pairs_min', metavar='min_value', dest='pairs_min',
+                    type=float, required=False, default=0,
+                    help='Minimum value of the pairs written to --pairs. Default: 0')
 parser.add_argument('-t', '--threads', metavar='threads', dest='t',
                     type=int, required=False, default=2,
                     help='Threads that would be used for makeblastdb and blast')
 parser.add_argument('-p', '--program', metavar='blast_program', dest='p',
                     type=str, required=False, default='blastp',
                     help='blast program that would be used (blastp or blastn)')
+parser.add_argument('-e', '--engine', metavar='engine', dest='e',
+                    type=str, required=False, default='pairwise',
+                    choices=['pairwise', 'allvsall', 'native'],
+                    help='pairwise: one blast per sequence pair; allvsall: one blast of all sequences against a single database; '
+                         'native: in-process alignment without BLAST')
+parser.add_argument('--align', metavar='alignment', dest='align',
+                    type=str, required=False, default='global',
+                    choices=['global', 'local'],
+                    help='Alignment used by the native engine (global or local). Default: global')
+parser.add_argument('--band', metavar='band_width', dest='band',
+                    type=int, required=False, default=0,
+                    help='Band width used by the native engine, 0 for a full alignment. Default: 0')
+parser.add_argument('--metric', metavar='metric', dest='metric',
+                    type=str, required=False, default='pident',
+                    choices=['pident', 'wident', 'af', 'bitscore'],
+                    help='Value that fills the matrix: pident, wident (length-weighted identity of all HSPs), '
+                         'af (alignment fraction of the query) or bitscore. Default: pident')
+parser.add_argument('--symmetric', metavar='policy', dest='symmetric',
+                    type=str, required=False, nargs='?', const='max', default=None,
+                    choices=['max', 'mean', 'qlen'],
+                    help='Make the matrix symmetric. The pairwise engine searches only one direction of every pair; '
+                         'the two directions of the allvsall engine are reconciled by max, mean or qlen. Default policy: max')
+parser.add_argument('--cache', metavar='cache_dir', dest='cache',
+                    type=str, required=False,
+                    help='Keep the identity of every pair in this directory, so that reruns only compute missing pairs')
+parser.add_argument('--cache_size', metavar='MB', dest='cache_size',
+                    type=int, required=False, default=0,
+                    help='Evict the least recently used pairs when the cache grows beyond this size. Default: unlimited')
+parser.add_argument('--memmap', dest='memmap',
+                    action='store_true', required=False,
+                    help='Keep the matrix in a memory-mapped file in the temporary folder instead of RAM. Default: False')
 parser.add_argument('-m', '--heatmap', metavar='heatmap', dest='m',
                     type=str, required=False,
                     help='Draw clustered heatmap.')
-parser.add_argument('--clean', metavar='clean', dest='c',
+parser.add_argument('--heatmap_max', metavar='num_sequences', dest='heatmap_max',
+                    type=int, required=False, default=2000,
+                    help='Draw the heatmap from at most this many cluster representatives. Default: 2000')
+parser.add_argument('--clean', dest='c',
                     action='store_true', required=False,
                     help='Clean temporary files. Default: False')
 args = parser.parse_args()
 
+if args.e == 'native' and args.metric == 'bitscore':
+    parser.error('--metric bitscore is only available with the blast engines')
+
 input_faa = args.i
-output_table = input_faa + '_ident.tsv' if args.o == None else args.o
+output_table = input_faa + '_ident.' + args.f if args.o == None else args.o
 tmp_folder = 'blast_matrix_tmp_' + str(random.randint(0,999999)).zfill(6)
 if args.p == 'blastp':
     blast_program = 'blastp'
@@ -74,6 +150,10 @@ else:
     raise IOError(f"Sorry, the temporary folder could not be created. Please remove the {tmp_folder} folder.")
 
 
+# blast output fields needed to aggregate the HSPs of a pair
+OUTFMT = '6 qseqid sseqid pident length qstart qend qlen bitscore'
+
+
 def run_mkblastdb(fi, tp):
     fo = fi + '.db'
     '''
@@ -100,6 +180,11 @@ def run_mkblastdb(fi, tp):
         print("Status : FAIL", exc.returncode, exc.output)
 
 
+def run_blast_star(para):
+    run_blast(*para)
+    return para
+
+
 def run_blast(q, o, db, e, b):
     '''
     q: query
@@ -116,7 +201,7 @@ def run_blast(q, o, db, e, b):
                 '-out', o,
                 '-db', db,
                 '-evalue', str(e),
-                '-outfmt', '6',
+                '-outfmt', OUTFMT,
                 '-num_threads', '1'
                 ]
     try:
@@ -131,17 +216,282 @@ def run_blast(q, o, db, e, b):
         print('output:', exc.output)
 
 
-def blast_Parser(fi):
+def run_allvsall(q, db, e, b, n, ms, dbsize, metric):
+    '''
+    q: query (all sequences)
+    db: database built from the same sequences
+    e: evalue
+    b: blast program
+    n: num_threads
+    ms: max_target_seqs (the number of sequences, so that no pair is dropped)
+    dbsize: effective database length, set to the mean sequence length so that
+            evalues stay comparable to those of the pairwise engine
+    metric: see hsp_metric
+
+    Yields (query, {target: value}) for every target hit by a query, as soon as
+    blast has finished that query. The output is parsed directly from the blast
+    stdout without any intermediate file.
+    '''
+    cmd_para = [
+                b,
+                '-query', q,
+                '-db', db,
+                '-evalue', str(e),
+                '-outfmt', OUTFMT,
+                '-max_target_seqs', str(ms),
+                '-dbsize', str(dbsize),
+                '-num_threads', str(n)
+                ]
+    process = subprocess.Popen(cmd_para,
+                               stdout=subprocess.PIPE,
+                               stderr=open(os.devnull, 'wb'),
+                               universal_newlines=True)
+    query_last = ''
+    hits = {}  # HSPs of every target of the current query
+    for line in process.stdout:
+        items = line.split("\t")
+        query, targ = items[0], items[1]
+        if query != query_last:
+            if hits:
+                yield query_last, {t: hsp_metric(h, metric) for t, h in hits.items()}
+            query_last = query
+            hits = {}
+        if query == targ:
+            continue  # self hit
+        if targ in hits:
+            if metric != 'pident':
+                hits[targ].append(items[2:])
+        else:
+            hits[targ] = [items[2:]]
+    if hits:
+        yield query_last, {t: hsp_metric(h, metric) for t, h in hits.items()}
+    process.stdout.close()
+    if process.wait():
+        raise RuntimeError(f"{b} exited with status {process.returncode}: {' '.join(cmd_para)}")
+
+
+def hsp_metric(hsps, metric):
     '''
-    fi: blast output (format 6)
+    hsps: [[pident, length, qstart, qend, qlen, bitscore], ...] of one pair, best first
+    metric:
+        pident: identity of the best HSP
+        wident: identity of the HSPs weighted by their alignment length
+        af: fraction of the query covered by the HSPs (%)
+        bitscore: sum of the bitscores of the HSPs
+    HSPs overlapping a better one on the query are left out, so that the same
+    region is never counted twice.
+    '''
+    if metric == 'pident':
+        return float(hsps[0][0])
+    kept = []  # query intervals of the HSPs used
+    ident = length = covered = bitscore = 0
+    for hsp in hsps:
+        start, end = sorted((int(hsp[2]), int(hsp[3])))
+        if any(start <= e and s <= end for s, e in kept):
+            continue
+        kept.append((start, end))
+        ident += float(hsp[0]) * int(hsp[1])
+        length += int(hsp[1])
+        covered += end - start + 1
+        bitscore += float(hsp[5])
+    if metric == 'wident':
+        return round(ident / length, 3)
+    if metric == 'af':
+        return round(100 * covered / int(hsps[0][4]), 3)
+    return bitscore
+
+
+def blast_Parser(fi, metric='pident'):
+    '''
+    fi: blast output (format as OUTFMT)
+    metric: see hsp_metric
+
+    Only the first line is read for pident.
     '''
     if not os.path.getsize(fi):
         return 0
 
+    hsps = []
     with open(fi) as input:
-        for line in input.readlines():
-            items = line.strip().split("\t")
-            return float(items[2])
+        for line in input:
+            hsps.append(line.rstrip("\n").split("\t")[2:])
+            if metric == 'pident':
+                break
+    return hsp_metric(hsps, metric)
+
+
+# Scoring used by the native engine, following the blastp and blastn defaults
+NATIVE_SCORING = {
+    # data_type: (gap open, gap extend)
+    'prot': (11, 1),
+    'nucl': (5, 2),
+}
+NEG_INF = -10 ** 8  # small enough to never win, large enough not to overflow int32
+_native_seqs = []  # encoded sequences shared with the pool workers
+_native_scores = None
+
+
+def native_alphabet(tp):
+    '''
+    tp: prot or nucl
+
+    return the alphabet, the substitution matrix as a NumPy array
+    and a 256-entry lookup table encoding bytes to alphabet indices
+    '''
+    if tp == 'prot':
+        from Bio.Align import substitution_matrices
+        blosum62 = substitution_matrices.load('BLOSUM62')
+        alphabet = blosum62.alphabet
+        scores = np.array(blosum62, dtype=np.int32)
+        unknown = alphabet.index('X')
+    else:
+        alphabet = 'ACGTN'
+        scores = np.full((5, 5), -3, dtype=np.int32)
+        np.fill_diagonal(scores, 2)
+        scores[4, :] = scores[:, 4] = -1
+        unknown = alphabet.index('N')
+    lut = np.full(256, unknown, dtype=np.uint8)
+    for i, c in enumerate(alphabet):
+        lut[ord(c)] = lut[ord(c.lower())] = i
+    if tp == 'nucl':
+        lut[ord('U')] = lut[ord('u')] = alphabet.index('T')
+    return alphabet, scores, lut
+
+
+def native_encode(seq, lut):
+    return lut[np.frombuffer(str(seq).encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def native_align(a, b, scores, gap_open, gap_extend, local=False, band=0):
+    '''
+    a, b: encoded sequences
+    scores: substitution matrix
+    local: Smith-Waterman instead of Needleman-Wunsch
+    band: only cells within this distance of the diagonal are computed (0: all cells)
+
+    Affine-gap alignment computed one row at a time with NumPy. The horizontal
+    gaps of a row are resolved with a running maximum, and the counts of the
+    best path are carried along instead of a traceback matrix, so memory stays
+    linear in the target length.
+    Return (identical positions, aligned positions, alignment length).
+    '''
+    n, m = len(a), len(b)
+    if n == 0 or m == 0:
+        return 0, 0, 0
+    cols = np.arange(m + 1)
+    # H: best score ending at (i, j); F: best score ending with a gap in b
+    # *C: identical and aligned positions of the corresponding path; *L: its length
+    if local:
+        H = np.zeros(m + 1, dtype=np.int32)
+    else:
+        H = -(gap_open + gap_extend * cols).astype(np.int32)
+        H[0] = 0
+    HC = np.zeros((2, m + 1), dtype=np.int32)
+    HL = np.zeros(m + 1, dtype=np.int32) if local else cols.astype(np.int32)
+    F = np.full(m + 1, NEG_INF, dtype=np.int32)
+    FC = np.zeros((2, m + 1), dtype=np.int32)
+    FL = np.zeros(m + 1, dtype=np.int32)
+    best, best_c, best_l = 0, (0, 0), 0
+    lo, hi = 1, m
+    for i in range(1, n + 1):
+        if band:
+            lo = max(1, i - band - max(0, n - m))
+            hi = min(m, i + band + max(0, m - n))
+            if lo > hi:
+                break
+        # cells reachable from the row above: diagonal or vertical gap
+        sub = scores[a[i - 1], b[lo - 1:hi]]
+        D = H[lo - 1:hi] + sub
+        DC = HC[:, lo - 1:hi] + np.stack((a[i - 1] == b[lo - 1:hi], np.ones(hi - lo + 1, dtype=bool)))
+        DL = HL[lo - 1:hi] + 1
+        open_f = H[lo:hi + 1] - gap_open - gap_extend
+        ext_f = F[lo:hi + 1] - gap_extend
+        use_open = open_f >= ext_f
+        F_row = np.where(use_open, open_f, ext_f)
+        FC_row = np.where(use_open, HC[:, lo:hi + 1], FC[:, lo:hi + 1])
+        FL_row = np.where(use_open, HL[lo:hi + 1], FL[lo:hi + 1]) + 1
+        use_d = D >= F_row
+        T = np.where(use_d, D, F_row)
+        TC = np.where(use_d, DC, FC_row)
+        TL = np.where(use_d, DL, FL_row)
+        if local:
+            reset = T <= 0
+            T[reset] = 0
+            TC[:, reset] = 0
+            TL[reset] = 0
+        # prepend the cell left of the band
+        if lo == 1:
+            left = 0 if local else -(gap_open + gap_extend * i)
+            left_l = 0 if local else i
+        else:
+            left, left_l = NEG_INF, 0
+        T = np.concatenate(([left], T))
+        TC = np.concatenate((np.zeros((2, 1), dtype=np.int32), TC), axis=1)
+        TL = np.concatenate(([left_l], TL))
+        # horizontal gaps: E[j] = max over k < j of T[k] - open - extend * (j - k)
+        idx = cols[lo - 1:hi + 1]
+        val = T + gap_extend * idx
+        run = np.maximum.accumulate(val)
+        pos = np.arange(len(val))
+        src = np.maximum.accumulate(np.where(val == run, pos, 0))[:-1]
+        E = run[:-1] - gap_open - gap_extend * idx[1:]
+        EC = TC[:, src]
+        EL = TL[src] + (pos[1:] - src)
+        use_t = T[1:] >= E
+        H_new = np.full(m + 1, NEG_INF, dtype=np.int32)
+        HC_new = np.zeros((2, m + 1), dtype=np.int32)
+        HL_new = np.zeros(m + 1, dtype=np.int32)
+        H_new[lo - 1] = left
+        HL_new[lo - 1] = left_l
+        H_new[lo:hi + 1] = np.where(use_t, T[1:], E)
+        HC_new[:, lo:hi + 1] = np.where(use_t, TC[:, 1:], EC)
+        HL_new[lo:hi + 1] = np.where(use_t, TL[1:], EL)
+        F_new = np.full(m + 1, NEG_INF, dtype=np.int32)
+        F_new[lo:hi + 1] = F_row
+        FC[:, lo:hi + 1] = FC_row
+        FL[lo:hi + 1] = FL_row
+        H, HC, HL, F = H_new, HC_new, HL_new, F_new
+        if local:
+            j = int(np.argmax(H))
+            if H[j] > best:
+                best, best_c, best_l = H[j], HC[:, j], HL[j]
+    if not local:
+        if hi < m or H[m] <= NEG_INF // 2:
+            return 0, 0, 0  # the band did not reach the end of both sequences
+        best_c, best_l = HC[:, m], HL[m]
+    return int(best_c[0]), int(best_c[1]), int(best_l)
+
+
+def native_init(seqs, scores):
+    global _native_seqs, _native_scores
+    _native_seqs = seqs
+    _native_scores = scores
+
+
+def native_rows(rows, tp, local, band, metric):
+    '''
+    rows: block of [(query index, target indices), ...]
+    metric: pident or wident (identity of the alignment), or af (aligned fraction of each sequence)
+
+    return [(i, j, value of i against j, value of j against i), ...]
+    '''
+    gap_open, gap_extend = NATIVE_SCORING[tp]
+    res = []
+    for i, targets in rows:
+        for j in targets.tolist():
+            matches, aligned, length = native_align(_native_seqs[i], _native_seqs[j], _native_scores,
+                                                    gap_open, gap_extend, local, band)
+            if metric == 'af':
+                res.append((i, j, round(100 * aligned / len(_native_seqs[i]), 3),
+                            round(100 * aligned / len(_native_seqs[j]), 3)))
+            else:
+                ident = round(100 * matches / length, 3) if length else 0
+                res.append((i, j, ident, ident))
+    return res
+
+
+def native_rows_star(para):
+    return native_rows(*para)
 
 
 def include_outputdir(s):
@@ -158,63 +508,607 @@ def draw_heatmap(df, out_pdf):
     cmap.savefig(out_pdf)
 
 
-if __name__ == "__main__":
-    pool = Pool(args.t)
+def similarity_rows(mat, start, end):
+    """
+    rows start:end of the matrix averaged with their reciprocal direction
+    """
+    return (np.array(mat[start:end]) + np.array(mat[:, start:end]).T) / 2
+
+
+def pick_representatives(mat, limit, top):
+    """
+    Farthest-point sampling: every new representative is the sequence least
+    similar to all representatives picked so far, so that the whole diversity
+    of the matrix is kept. Every sequence is assigned to its most similar
+    representative.
+    top: value of a sequence against itself
+
+    return (representative indices, representative ordinal of every sequence)
+    """
+    num = len(mat)
+    reps = [0]
+    nearest = similarity_rows(mat, 0, 1)[0]
+    nearest[0] = np.inf
+    assign = np.zeros(num, dtype=np.int64)
+    for k in range(1, min(limit, num)):
+        i = int(np.argmin(nearest))
+        reps.append(i)
+        row = similarity_rows(mat, i, i + 1)[0]
+        row[i] = top
+        closer = row > nearest
+        nearest[closer] = row[closer]
+        assign[closer] = k
+        nearest[i] = np.inf
+    return np.array(reps), assign
+
+
+def condensed_distance(mat, top, block=1024):
+    """
+    Condensed (upper triangle) distance vector in float32, top - similarity,
+    built a block of rows at a time.
+    """
+    num = len(mat)
+    dist = np.empty(num * (num - 1) // 2, dtype=np.float32)
+    pos = 0
+    for start in range(0, num, block):
+        end = min(start + block, num)
+        rows = similarity_rows(mat, start, end)
+        for i in range(start, end):
+            row = top - rows[i - start, i + 1:]
+            dist[pos:pos + len(row)] = row
+            pos += len(row)
+    return np.clip(dist, 0, None, out=dist)
 
-    seq_ids = []
-    for seq_record in SeqIO.parse(input_faa, "fasta"):
-        single_seq = include_outputdir(seq_record.id) + ".faa"
-        SeqIO.write(seq_record, single_seq, "fasta")
-        seq_ids.append(seq_record.id)
+
+def draw_large_heatmap(mat, seq_ids, out, limit, top):
+    """
+    Clustered heatmap for matrices too large for sns.clustermap.
+    Above limit sequences, the heatmap shows cluster representatives only.
+    The linkage is computed once on a condensed float32 distance vector and
+    the cells are rasterised. The ordering of every sequence, next to its
+    representative, is written to out + '.order.tsv'.
+    """
+    import seaborn as sns
+    from scipy.cluster.hierarchy import linkage, leaves_list
+
+    reps, assign = pick_representatives(mat, limit, top)
+    sub = np.array(mat[np.ix_(reps, reps)]).T  # targets as rows
+    linkage_matrix = linkage(condensed_distance(sub, top), method='average')
+    order = leaves_list(linkage_matrix)
+    sizes = np.bincount(assign, minlength=len(reps))
+
+    with open(out + '.order.tsv', 'w') as fo:
+        fo.write('order\tseq_id\trepresentative\n')
+        members = np.argsort(assign, kind='stable')
+        bounds = np.concatenate(([0], np.cumsum(sizes)))
+        n = 0
+        for k in order:
+            for i in members[bounds[k]:bounds[k + 1]].tolist():
+                n += 1
+                fo.write(f'{n}\t{seq_ids[i]}\t{seq_ids[reps[k]]}\n')
+
+    labels = [f'{seq_ids[r]} ({n})' for r, n in zip(reps.tolist(), sizes.tolist())]
+    np.fill_diagonal(sub, top)
+    df = pd.DataFrame(sub, index=labels, columns=labels)
+    show_labels = len(reps) <= 100
+    cmap = sns.clustermap(df, row_linkage=linkage_matrix, col_linkage=linkage_matrix,
+                          xticklabels=show_labels, yticklabels=show_labels, rasterized=True)
+    cmap.savefig(out, dpi=300)
+
+
+class MatrixStats:
+    """
+    Maximum, minimum and mean identity, updated as results arrive
+    so that no copy of the matrix is needed to compute them.
+    """
+    labels = {
+        'pident': ('Identity', '%'),
+        'wident': ('Weighted Identity', '%'),
+        'af': ('Alignment Fraction', '%'),
+        'bitscore': ('Bitscore', ''),
+    }
+
+    def __init__(self, seq_ids, metric='pident'):
+        self.seq_ids = seq_ids
+        self.label, self.unit = self.labels[metric]
+        self.count = 0
+        self.total = 0.0
+        self.max = (float('-inf'), None, None)
+        self.min = (float('inf'), None, None)
+
+    def add(self, ident, query, targ):
+        self.count += 1
+        self.total += ident
+        if ident > self.max[0]:
+            self.max = (ident, query, targ)
+        if ident < self.min[0]:
+            self.min = (ident, query, targ)
+
+    def add_block(self, block, start):
+        """
+        block: rows start... of a symmetric matrix. Only cells above the
+        diagonal are read, and each of them stands for both directions.
+        """
+        rows = start + np.arange(len(block))
+        upper = np.arange(block.shape[1])[None, :] > rows[:, None]
+        if not upper.any():
+            return
+        values = block[upper]
+        self.count += 2 * len(values)
+        self.total += 2 * float(values.sum(dtype=np.float64))
+        masked = np.where(upper, block, np.nan)
+        targ, query = np.unravel_index(np.nanargmax(masked), block.shape)
+        if block[targ, query] > self.max[0]:
+            self.max = (round(float(block[targ, query]), 3), int(query), int(start + targ))
+        targ, query = np.unravel_index(np.nanargmin(masked), block.shape)
+        if block[targ, query] < self.min[0]:
+            self.min = (round(float(block[targ, query]), 3), int(query), int(start + targ))
+
+    def add_zeros(self, count, query, targ):
+        """
+        count pairs of the given query without any hit, targ being one of them.
+        """
+        self.count += count
+        if count and 0 < self.min[0]:
+            self.min = (0.0, query, targ)
+
+    def report(self):
+        num = len(self.seq_ids)
+        mean_ident = self.total / max(num * (num - 1), 1)
+        max_ident, max_q, max_t = self.max
+        min_ident, min_q, min_t = self.min
+        print('\n***** Statistics *****')
+        print(f'Maximum {self.label}:\n{max_ident}{self.unit}: {self.seq_ids[max_q]} -> {self.seq_ids[max_t]}')
+        print(f'Mimimum {self.label}:\n{min_ident}{self.unit}: {self.seq_ids[min_q]} -> {self.seq_ids[min_t]}')
+        print(f'Average {self.label}: {mean_ident}{self.unit}')
+
+
+def new_matrix(num, memmap=False):
+    """
+    Preallocate the identity matrix. mat[q, t] holds the identity of query q
+    against target t: results arrive grouped by query, so each query fills a
+    contiguous row, which keeps a memory-mapped matrix from touching one page
+    per target. The writers transpose it blockwise to the output layout, where
+    columns are queries as in the former DataFrame layout.
+    Pairs not computed yet are NaN.
+    With memmap, the matrix lives in a file in the temporary folder instead of RAM.
+    """
+    if memmap:
+        mat = np.memmap(include_outputdir('matrix.f32'), dtype=np.float32,
+                        mode='w+', shape=(num, num))
+        mat[:] = np.nan
+        return mat
+    return np.full((num, num), np.nan, dtype=np.float32)
+
+
+def missing_pairs(mat, block=1024):
+    """
+    return a boolean matrix of the pairs not computed yet, diagonal excluded
+    """
+    num = len(mat)
+    missing = np.zeros((num, num), dtype=bool)
+    for start in range(0, num, block):
+        missing[start:start + block] = np.isnan(mat[start:start + block])
+    np.fill_diagonal(missing, False)
+    return missing
+
+
+class ResultCache:
+    """
+    Persistent identities of sequence pairs, keyed on the SHA-1 of both sequences
+    and on the search parameters, so that an interrupted job can be resumed and
+    adding sequences to a set only computes the new pairs.
+    The cache is a SQLite database, which can be shared by concurrent jobs.
+    """
+    commit_every = 10000
+
+    def __init__(self, folder, records, params):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = os.path.join(folder, 'blast_matrix_cache.sqlite')
+        self.conn = sqlite3.connect(self.path, timeout=600)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                          'qhash TEXT, thash TEXT, params TEXT, ident REAL, atime INTEGER, '
+                          'PRIMARY KEY (qhash, thash, params))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pairs_atime ON pairs (atime)')
+        self.conn.commit()
+        self.hashes = [hashlib.sha1(str(r.seq).upper().encode()).hexdigest() for r in records]
+        self.params = params
+        self.now = int(time.time())
+        self.pending = []
+
+    def load(self, mat, stats):
+        """
+        Fill the matrix with every cached pair of the current sequences.
+        """
+        cur = self.conn.cursor()
+        cur.execute('CREATE TEMP TABLE cur (hash TEXT, idx INTEGER)')
+        cur.executemany('INSERT INTO cur VALUES (?, ?)', ((h, i) for i, h in enumerate(self.hashes)))
+        cur.execute('CREATE INDEX cur_hash ON cur (hash)')
+        cur.execute('SELECT q.idx, t.idx, pairs.ident FROM pairs '
+                    'JOIN cur AS q ON pairs.qhash = q.hash JOIN cur AS t ON pairs.thash = t.hash '
+                    'WHERE pairs.params = ? AND q.idx != t.idx', (self.params,))
+        loaded = 0
+        for query, targ, ident in cur:
+            mat[query, targ] = ident
+            stats.add(ident, query, targ)
+            loaded += 1
+        # refresh the access time of the pairs in use, for the LRU eviction
+        cur.execute('UPDATE pairs SET atime = ? WHERE params = ? '
+                    'AND qhash IN (SELECT hash FROM cur) AND thash IN (SELECT hash FROM cur)',
+                    (self.now, self.params))
+        cur.execute('DROP TABLE cur')
+        self.conn.commit()
+        return loaded
+
+    def add(self, query, targ, ident):
+        self.pending.append((self.hashes[query], self.hashes[targ], self.params, ident, self.now))
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany('INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?)', self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def evict(self, max_mb):
+        """
+        Drop the least recently used pairs until the cache fits in max_mb.
+        """
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()[0]
+        size = page_size * page_count
+        limit = max_mb * 1024 * 1024
+        if size <= limit:
+            return
+        rows = self.conn.execute('SELECT COUNT(*) FROM pairs').fetchone()[0]
+        drop = rows - int(rows * limit / size)
+        self.conn.execute('DELETE FROM pairs WHERE rowid IN '
+                          '(SELECT rowid FROM pairs ORDER BY atime LIMIT ?)', (drop,))
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+        print(f'{drop} pairs were evicted from the cache.')
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def symmetrize(mat, policy, lengths, stats, block=1024):
+    """
+    Reconcile the two search directions of every pair, mat[q, t] and mat[t, q]:
+    max: the higher identity of both directions
+    mean: the average of both directions
+    qlen: the average weighted by the query length of each direction
+    For mean and qlen, a direction without any hit is ignored as long as the
+    other one has a hit. stats is filled from the reconciled values.
+    """
+    num = len(lengths)
+    lengths = np.asarray(lengths, dtype=np.float32)
+    for start in range(0, num, block):
+        end = min(start + block, num)
+        a = np.array(mat[start:end])      # a[i, j]: query i -> target j
+        b = np.array(mat[:, start:end]).T  # b[i, j]: query j -> target i
+        if policy == 'max':
+            comb = np.maximum(a, b)
+        else:
+            if policy == 'qlen':
+                wa, wb = lengths[start:end, None], lengths[None, :]
+            else:
+                wa, wb = 1, 1
+            wa = np.where(a > 0, wa, 0)
+            wb = np.where(b > 0, wb, 0)
+            weight = wa + wb
+            comb = np.where(weight > 0, (a * wa + b * wb) / np.where(weight > 0, weight, 1), 0)
+        comb = comb.astype(np.float32)
+        mat[start:end] = comb
+        mat[:, start:end] = comb.T
+        stats.add_block(comb, start)
+
+
+def write_table(mat, seq_ids, out, block=1024):
+    """
+    Write the matrix in tab-delimited format, targets as rows,
+    transposing a block of rows at a time.
+    """
+    row_fmt = '\t'.join(['%.6g'] * len(seq_ids))
+    with open(out, 'w') as fo:
+        fo.write('\t' + '\t'.join(seq_ids) + '\n')
+        for start in range(0, len(seq_ids), block):
+            for i, row in enumerate(np.asarray(mat[:, start:start + block]).T.tolist()):
+                fo.write(seq_ids[start + i] + '\t' + row_fmt % tuple(row) + '\n')
+
+
+def write_npy(mat, seq_ids, out, block=1024):
+    """
+    Write the matrix as a float32 .npy file, which downstream tools can open
+    with np.load(out, mmap_mode='r'), and the IDs one per line alongside.
+    Targets are rows, transposed a block of rows at a time.
+    """
+    # Written at the exact path, which np.save would append .npy to
+    num = len(seq_ids)
+    dst = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=(num, num))
+    for start in range(0, num, block):
+        dst[start:start + block] = mat[:, start:start + block].T
+    dst.flush()
+    del dst
+    with open(out + '.ids.txt', 'w') as fo:
+        fo.write('\n'.join(seq_ids) + '\n')
+
+
+def write_h5(mat, seq_ids, out, block=1024):
+    """
+    Write the matrix into a chunked, compressed HDF5 dataset, targets as rows,
+    transposing a block of rows at a time.
+    """
+    import h5py
+
+    num = len(seq_ids)
+    chunk = min(num, 256)
+    with h5py.File(out, 'w') as fo:
+        dset = fo.create_dataset('matrix', shape=(num, num), dtype='f4',
+                                 chunks=(chunk, chunk), compression='gzip')
+        dset.attrs['layout'] = 'matrix[target, query]'
+        for start in range(0, num, block):
+            dset[start:start + block] = np.asarray(mat[:, start:start + block]).T
+        fo.create_dataset('ids', data=seq_ids, dtype=h5py.string_dtype())
+
+
+def write_pairs(mat, seq_ids, out, min_value, block=1024):
+    """
+    Write the off-diagonal pairs reaching min_value in long format
+    (query, target, value), a block of rows at a time.
+    """
+    ids = np.array(seq_ids, dtype=object)
+    writer = None
+    if out.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([('query', pa.string()), ('target', pa.string()), ('value', pa.float32())])
+        writer = pq.ParquetWriter(out, schema)
+    else:
+        fo = open(out, 'w')
+        fo.write('query\ttarget\tvalue\n')
+    for start in range(0, len(seq_ids), block):
+        rows = np.array(mat[start:start + block])
+        rows[np.arange(len(rows)), np.arange(start, start + len(rows))] = np.nan
+        query, targ = np.nonzero(rows >= min_value)
+        values = rows[query, targ]
+        query += start
+        if writer:
+            writer.write_table(pa.table({'query': ids[query].tolist(), 'target': ids[targ].tolist(),
+                                         'value': values}, schema=schema))
+        else:
+            fo.writelines(f'{q}\t{t}\t{v:.6g}\n' for q, t, v in
+                          zip(ids[query].tolist(), ids[targ].tolist(), values.tolist()))
+    if writer:
+        writer.close()
+    else:
+        fo.close()
+
+
+def pairwise_search(records, pool, mat, stats, symmetric=False, cache=None):
+    """
+    Run one blast per ordered sequence pair not computed yet and fill the identity matrix.
+    With symmetric, only one direction of every pair is searched and mirrored.
+    """
+    pairs = combinations if symmetric else permutations
+    seq_ids = [seq_record.id for seq_record in records]
+    todo = []
+    for query, targ in pairs(range(len(seq_ids)), 2):
+        if not np.isnan(mat[query, targ]):
+            if symmetric and np.isnan(mat[targ, query]):
+                mat[targ, query] = mat[query, targ]  # reuse the cached direction
+                stats.add(float(mat[query, targ]), targ, query)
+            continue
+        if symmetric and not np.isnan(mat[targ, query]):
+            mat[query, targ] = mat[targ, query]
+            stats.add(float(mat[targ, query]), query, targ)
+            continue
+        todo.append((query, targ))
+    needed = sorted(set(i for pair in todo for i in pair))
+
+    for i in needed:
+        single_seq = include_outputdir(seq_ids[i]) + ".faa"
+        SeqIO.write(records[i], single_seq, "fasta")
 
     # build parameters for mkblastdb
-    mkblastdb_para = [(include_outputdir(i + '.faa'), data_type) for i in seq_ids]
+    mkblastdb_para = [(include_outputdir(seq_ids[i] + '.faa'), data_type) for i in needed]
     # run mkblastdb in parallel
     pool.starmap(run_mkblastdb, mkblastdb_para)
 
     blast_para = []  # build parameters for blast
-    for query, targ in permutations(seq_ids, 2):
-        blast_out = include_outputdir(query + '+' + targ + '_blast')
-        blast_query = include_outputdir(query + '.faa')
-        blast_targ = include_outputdir(targ + '.faa.db')
+    for query, targ in todo:
+        blast_out = include_outputdir(seq_ids[query] + '+' + seq_ids[targ] + '_blast')
+        blast_query = include_outputdir(seq_ids[query] + '.faa')
+        blast_targ = include_outputdir(seq_ids[targ] + '.faa.db')
         blast_para.append((blast_query, blast_out, blast_targ, '1e-5', blast_program))
+    index = {para[1]: pair for para, pair in zip(blast_para, todo)}
 
-    data = {}
-    pool.starmap(run_blast, blast_para)
-    
-    for query, targ in permutations(seq_ids, 2):
-        blast_out = include_outputdir(query + '+' + targ + '_blast')
-        ident = blast_Parser(blast_out)
-        if data.get(query):
-            data[query][targ] = ident
-        else:
-            data[query] = {}
-            data[query][targ] = ident
+    # results are collected as soon as each blast is finished
+    for para in pool.imap_unordered(run_blast_star, blast_para):
+        query, targ = index[para[1]]
+        ident = blast_Parser(para[1], args.metric)
+        mat[query, targ] = ident
+        stats.add(ident, query, targ)
+        if cache:
+            cache.add(query, targ, ident)
+        if symmetric:
+            mat[targ, query] = ident
+            stats.add(ident, targ, query)
 
-    df = pd.DataFrame(data).sort_index().sort_index(axis=1)
 
+def plan_allvsall(mat, block=1024):
+    """
+    Choose which searches cover the pairs not computed yet.
+    A greedy vertex cover picks the sequences involved in most of the missing
+    pairs (typically the ones just added). They are searched against every
+    sequence, and every other sequence is searched against them, so adding
+    sequences costs O(new x all) rather than O(all x all).
 
-    mean_ident = df.mean(skipna = True).mean()
+    return [(query indices, target indices), ...]
+    """
+    num = len(mat)
+    missing = missing_pairs(mat, block)
+    degree = missing.sum(axis=0) + missing.sum(axis=1)
+    if not degree.any():
+        return []
+    picked = np.zeros(num, dtype=bool)
+    while degree.max() > 0:
+        i = int(np.argmax(degree))
+        picked[i] = True
+        degree[i] = 0
+        covered = missing[i].astype(np.int64) + missing[:, i]
+        degree[~picked] -= covered[~picked]
+        if picked.sum() > num // 2:
+            return [(np.arange(num), np.arange(num))]
+    new, old = np.flatnonzero(picked), np.flatnonzero(~picked)
+    searches = [(new, np.arange(num))]
+    if len(old):
+        searches.append((old, new))
+    return searches
 
-    max_qur_tar = df.stack().idxmax()
-    max_ident = df.loc[max_qur_tar]
-    min_qur_tar = df.stack().idxmin()
-    min_ident = df.loc[min_qur_tar]
 
-    print('\n***** Statistics *****')
-    print(f'Maximum Identity:\n{max_ident}%: {max_qur_tar[0]} -> {max_qur_tar[1]}')
-    print(f'Mimimum Identity:\n{min_ident}%: {min_qur_tar[0]} -> {min_qur_tar[1]}')
-    print(f'Average Identity: {mean_ident}%')
+def allvsall_search(records, mat, stats, cache=None):
+    """
+    Search all sequences against a single database built from the whole input
+    and stream the tabular output into the identity matrix.
+    Sequences are renamed to their ordinal so that long or oddly formatted
+    headers cannot break makeblastdb.
+    With a cache, only the sequences involved in missing pairs are searched.
+    """
+    num = len(records)
+    if cache:
+        searches = plan_allvsall(mat)
+    else:
+        searches = [(np.arange(num), np.arange(num))]
 
-    df = df.fillna(100)  # Fill NaN values with 100
-    df.to_csv(output_table, sep='\t')
+    def finish(query, hits, targets):
+        # record the hits of a query; the other targets had no hit and get 0
+        for targ, ident in hits.items():
+            targ = int(targ[1:])
+            if np.isnan(mat[query, targ]):
+                mat[query, targ] = ident
+                stats.add(ident, query, targ)
+                if cache:
+                    cache.add(query, targ, ident)
+        zeros = targets[np.isnan(mat[query, targets]) & (targets != query)]
+        if len(zeros):
+            mat[query, zeros] = 0
+            stats.add_zeros(len(zeros), query, int(zeros[0]))
+            if cache:
+                for targ in zeros.tolist():
+                    cache.add(query, targ, 0)
 
-    if args.c:
-        shutil.rmtree(tmp_folder)
+    for n, (queries, targets) in enumerate(searches):
+        query_faa = include_outputdir(f'allvsall_{n}_query.faa')
+        targ_faa = include_outputdir(f'allvsall_{n}_target.faa')
+        total_len = 0
+        for fasta, indices in ((query_faa, queries), (targ_faa, targets)):
+            with open(fasta, 'w') as fo:
+                for i in indices.tolist():
+                    fo.write(f'>s{i}\n{records[i].seq}\n')
+                    if fasta == targ_faa:
+                        total_len += len(records[i])
+        run_mkblastdb(targ_faa, data_type)
 
-    ######## ~ draw clustered heatmap ~ ########
-    if args.m:
-        draw_heatmap(df, args.m)
-    
+        # blast reports queries in input order, so queries skipped in its
+        # output are finished and had no hit at all
+        order = queries.tolist()
+        pos = 0
+        dbsize = max(total_len // max(len(targets), 1), 1)
+        for query, hits in run_allvsall(query_faa, targ_faa + '.db', '1e-5',
+                                        blast_program, args.t, len(targets), dbsize, args.metric):
+            query = int(query[1:])
+            while order[pos] != query:
+                finish(order[pos], {}, targets)
+                pos += 1
+            finish(query, hits, targets)
+            pos += 1
+        for query in order[pos:]:
+            finish(query, {}, targets)
 
 
+def native_search(records, threads, mat, stats, cache=None):
+    """
+    Align every sequence pair not computed yet in-process, distributing blocks of
+    rows over a process pool. Both alignment directions give the same identity,
+    so only one of them is computed and mirrored.
+    """
+    _, scores, lut = native_alphabet(data_type)
+    seqs = [native_encode(seq_record.seq, lut) for seq_record in records]
+    num = len(seqs)
+    missing = missing_pairs(mat)
+    missing |= missing.T
+    rows = [(i, np.flatnonzero(missing[i, i + 1:]) + i + 1) for i in range(num)]
+    rows = [(i, targets) for i, targets in rows if len(targets)]
+    del missing
+    # small blocks keep the workers busy although later rows hold fewer pairs
+    block = max(1, len(rows) // (threads * 8))
+    blocks = [(rows[i:i + block], data_type, args.align == 'local', args.band, args.metric)
+              for i in range(0, len(rows), block)]
+
+    with Pool(threads, initializer=native_init, initargs=(seqs, scores)) as pool:
+        for res in pool.imap_unordered(native_rows_star, blocks):
+            for i, j, ident_ij, ident_ji in res:
+                for query, targ, ident in ((i, j, ident_ij), (j, i, ident_ji)):
+                    if np.isnan(mat[query, targ]):
+                        mat[query, targ] = ident
+                        stats.add(ident, query, targ)
+                        if cache:
+                            cache.add(query, targ, ident)
+
+
+if __name__ == "__main__":
+    records = sorted(SeqIO.parse(input_faa, "fasta"), key=lambda r: r.id)
+    seq_ids = [seq_record.id for seq_record in records]
+
+    mat = new_matrix(len(seq_ids), args.memmap)
+    stats = MatrixStats(seq_ids, args.metric)
+    cache = None
+    if args.cache:
+        params = f'{args.e}|{blast_program}|1e-5|{args.metric}'
+        if args.e == 'native':
+            params = f'{args.e}|{data_type}|{args.align}|{args.band}|{args.metric}'
+        cache = ResultCache(args.cache, records, params)
+        print(f'{cache.load(mat, stats)} pairs were loaded from the cache.')
+
+    if args.e == 'allvsall':
+        allvsall_search(records, mat, stats, cache)
+        if args.symmetric:
+            stats = MatrixStats(seq_ids, args.metric)
+            symmetrize(mat, args.symmetric, [len(r) for r in records], stats)
+    elif args.e == 'native':
+        native_search(records, args.t, mat, stats, cache)
+    else:
+        pool = Pool(args.t)
+        pairwise_search(records, pool, mat, stats, args.symmetric is not None, cache)
+
+    if cache:
+        cache.flush()
+        if args.cache_size:
+            cache.evict(args.cache_size)
+        cache.close()
+
+    stats.report()
+
+    # no self comparison is made, a sequence is 100% identical to itself
+    np.fill_diagonal(mat, 0 if args.metric == 'bitscore' else 100)
+    if args.f == 'npy':
+        write_npy(mat, seq_ids, output_table)
+    elif args.f == 'h5':
+        write_h5(mat, seq_ids, output_table)
+    else:
+        write_table(mat, seq_ids, output_table)
+    if args.pairs:
+        write_pairs(mat, seq_ids, args.pairs, args.pairs_min)
+
+    ######## ~ draw clustered heatmap ~ ########
+    if args.m and len(seq_ids) > args.heatmap_max:
+        draw_large_heatmap(mat, seq_ids, args.m, args.heatmap_max,
+                           float(np.max(mat)) if args.metric == 'bitscore' else 100)
+    elif args.m:
+        draw_heatmap(pd.DataFrame(mat.T, index=seq_ids, columns=seq_ids), args.m)
+
+    if args.c:
+        shutil.rmtree(tmp_folder)
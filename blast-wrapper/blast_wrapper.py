@@ -18,62 +18,229 @@ $ python blast_wrapper.py -b blastn -q query.fna -o output -df database.fna \
 $ python blast_wrapper.py -b blastn -q query.fna -o output -df database.fna \
                           -e 1e-10 -n 5 -ms 3 --no_qseq
 
+## Databases shared by many jobs, cached by content in a common directory of at most 50 GB:
+$ python blast_wrapper.py -q query.faa -df database.faa --db_cache /shared/blastdb --db_cache_size 50
+
+## Compressed files (gzip or zstd, detected from their content) are read as they are,
+## and the output is compressed according to its extension (.gz or .zst):
+$ python blast_wrapper.py -q query.faa.gz -df database.faa.zst -o output.tsv.gz
+
+## Large query sets, 4 chunks searched at the same time with 4 threads each:
+$ python blast_wrapper.py -q query.faa -df database.faa -n 16 -k 4
+
+## From Python, e.g. in a pipeline:
+>>> from blast_wrapper import prepare_database, blast_search
+>>> db = prepare_database('database.faa', 'blastp')
+>>> blast_search('query.faa', 'query.faa_blast.out', db, idt=30, qc=50)
+
+## Many query files against one database: see blast_wrapper_batch.py
+
 *Any change to output format by -f option may lead to errors when parsing output results.
 """
 
 import os
 import sys
 import argparse
-from collections import defaultdict
+import subprocess
+import hashlib
+import shutil
+import time
+import io
+import gzip
+import threading
+import itertools
+from multiprocessing import Pool
+try:
+    import fcntl  # Locks of the databases in use, unix-like systems only
+except ImportError:
+    fcntl = None
 
 __author__ = "Heyu Lin"
 __contact__ = "heyu.lin(AT)student.unimelb.edu.au"
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-q', '--query', metavar='query_fasta', dest='q',
-                    type=str, required=True)
-parser.add_argument('-o', '--output', metavar='output', dest='o',
-                    type=str)
-parser.add_argument('-df', '--database_fasta', metavar='database_fasta',
-                    dest='df', type=str,
-                    help='fasta file to be used as database')
-parser.add_argument('-db', '--database', metavar='database',
-                    dest='db', type=str,
-                    help='blast database which has already been made')
-parser.add_argument('-e', '--evalue', metavar='max_e-value', dest='e',
-                    type=float, default=1e-5,
-                    help='threshod e-value for blast (default=1e-5)')
-parser.add_argument('-ms', '--max_target_seqs', metavar='num_sequences',
-                    dest='ms', type=int, default=1,
-                    help='specify the max_number of target seqs for hits per query (default=1)')
-parser.add_argument('-n', '--num_threads', metavar='num_cpu',
-                    dest='n', type=int, default=3,
-                    help='specify the number of threads used by blast (default=3)')
-parser.add_argument('-b', '--blast_program', metavar='blast+ program',
-                    dest='b', type=str, default='blastp',
-                    help='specify the blast program (default=blastp)')
-parser.add_argument('-id', '--identity', metavar='identity_threshold',
-                    dest='idt', type=float, default=0,
-                    help='specify the threshold of identity (default=0)')
-parser.add_argument('-qc', '--qcov', metavar='coverage_threshold',
-                    dest='qc', type=float, default=0,
-                    help='specify the threshold of query coverage (default=0)')
-parser.add_argument('--no_qseq', metavar='hide qseq column',
-                    dest='nq', nargs="?", const=True, default=False,
-                    help='no query sequences will be showed if this argument is added')
-# You're not going to like to change this default output format.
-# Any change to this outfmt argument may lead to exceptions for query coverage calculation
-parser.add_argument('-f', '--outfmt', metavar='output_format*',
-                    dest='f', type=str,
-                    default='"6 qseqid sseqid pident length mismatch gapopen ' \
-                    + 'qstart qend sstart send qlen slen evalue bitscore"',
-                    help='outfmt defined by blast+, it is dangerous to change the default value')
-args = parser.parse_args()
+# Default output format, which the parser relies on
+OUTFMT = '6 qseqid sseqid pident length mismatch gapopen ' \
+    + 'qstart qend sstart send qlen slen evalue bitscore'
+HEADER = [
+            'qid', 'sid', 'ident%', 'aln_len', 'miss',
+            'gap', 'qstart', 'qend', 'sstart', 'send',
+            'qlen', 'slen', 'evalue', 'bitscore', 'qcov%', 'qseq'
+        ]
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-q', '--query', metavar='query_fasta', dest='q',
+                        type=str, required=True)
+    parser.add_argument('-o', '--output', metavar='output', dest='o',
+                        type=str)
+    parser.add_argument('-df', '--database_fasta', metavar='database_fasta',
+                        dest='df', type=str,
+                        help='fasta file to be used as database')
+    parser.add_argument('-db', '--database', metavar='database',
+                        dest='db', type=str,
+                        help='blast database which has already been made')
+    parser.add_argument('--db_cache', metavar='cache_directory',
+                        dest='dc', type=str,
+                        help='directory where databases made from -df are cached by content, '
+                        'to be reused by any job, whatever the path of the fasta')
+    parser.add_argument('--db_cache_size', metavar='size_in_GB',
+                        dest='dcs', type=float, default=0,
+                        help='disk budget of --db_cache, the least recently used databases '
+                        'being removed beyond it (default=0, unlimited)')
+    parser.add_argument('-e', '--evalue', metavar='max_e-value', dest='e',
+                        type=float, default=1e-5,
+                        help='threshod e-value for blast (default=1e-5)')
+    parser.add_argument('-ms', '--max_target_seqs', metavar='num_sequences',
+                        dest='ms', type=int, default=1,
+                        help='specify the max_number of target seqs for hits per query (default=1)')
+    parser.add_argument('-n', '--num_threads', metavar='num_cpu',
+                        dest='n', type=int, default=3,
+                        help='specify the number of threads used by blast (default=3)')
+    parser.add_argument('-k', '--chunks', metavar='num_chunks',
+                        dest='k', type=int, default=1,
+                        help='split the query into this number of chunks of about the same number of residues, '
+                        'searched at the same time and sharing the -n threads (default=1)')
+    parser.add_argument('-b', '--blast_program', metavar='blast+ program',
+                        dest='b', type=str, default='blastp',
+                        help='specify the blast program (default=blastp)')
+    parser.add_argument('-id', '--identity', metavar='identity_threshold',
+                        dest='idt', type=float, default=0,
+                        help='specify the threshold of identity (default=0)')
+    parser.add_argument('-qc', '--qcov', metavar='coverage_threshold',
+                        dest='qc', type=float, default=0,
+                        help='specify the threshold of query coverage (default=0)')
+    parser.add_argument('-sc', '--scov', metavar='coverage_threshold',
+                        dest='sc', type=float, default=0,
+                        help='specify the threshold of subject coverage (default=0)')
+    parser.add_argument('-br', '--bitscore_ratio', metavar='ratio',
+                        dest='br', type=float, default=0,
+                        help='only keep hits whose bitscore is at least this ratio (0-1) '
+                        'of the best bitscore of their query (default=0)')
+    parser.add_argument('--no_qseq', metavar='hide qseq column',
+                        dest='nq', nargs="?", const=True, default=False,
+                        help='no query sequences will be showed if this argument is added')
+    # You're not going to like to change this default output format.
+    # Any change to this outfmt argument may lead to exceptions for query coverage calculation
+    parser.add_argument('-f', '--outfmt', metavar='output_format*',
+                        dest='f', type=str,
+                        default=OUTFMT,
+                        help='outfmt defined by blast+, it is dangerous to change the default value')
+    return parser.parse_args(argv)
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compression(fi):
+    '''
+    return 'gzip', 'zstd' or None, according to the first bytes of the file
+    '''
+    with open(fi, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+class PipeWriter:
+    '''
+    Text file written through a compression program, e.g. pigz
+    '''
+    def __init__(self, cmd, fo):
+        self.out = open(fo, 'wb')
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.out)
+        self.stream = io.TextIOWrapper(self.process.stdin)
+        self.cmd = cmd[0]
+
+    def write(self, s):
+        return self.stream.write(s)
+
+    def writelines(self, lines):
+        self.stream.writelines(lines)
+
+    def close(self):
+        self.stream.close()
+        returncode = self.process.wait()
+        self.out.close()
+        if returncode:
+            raise RuntimeError('{} exited with status {}'.format(self.cmd, returncode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_file(fi, mode='r', threads=1):
+    '''
+    Open a plain, gzip or zstd file, in text mode unless mode is 'rb'.
+    For reading, the compression is detected from the first bytes of the file.
+    For writing, it follows the extension (.gz or .zst): pigz or zstandard
+    compress with threads if they are installed, otherwise gzip or zstd.
+    zstandard is optional, the zstd program being used without it.
+    '''
+    if mode.startswith('w'):
+        if fi.endswith('.gz'):
+            if shutil.which('pigz'):
+                return PipeWriter(['pigz', '-c', '-p', str(threads)], fi)
+            return gzip.open(fi, 'wt')
+        if fi.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                return PipeWriter(['zstd', '-q', '-c', '-T{}'.format(threads)], fi)
+            writer = zstandard.ZstdCompressor(threads=threads).stream_writer(open(fi, 'wb'), closefd=True)
+            return io.TextIOWrapper(writer)
+        return open(fi, mode)
+    codec = compression(fi)
+    if codec == 'gzip':
+        stream = gzip.open(fi, 'rb')
+    elif codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            stream = subprocess.Popen(['zstd', '-q', '-d', '-c', fi], stdout=subprocess.PIPE).stdout
+        else:
+            reader = zstandard.ZstdDecompressor().stream_reader(open(fi, 'rb'), closefd=True,
+                                                                read_across_frames=True)
+            stream = io.BufferedReader(reader)
+    else:
+        return open(fi, mode)
+    return stream if mode == 'rb' else io.TextIOWrapper(stream)
+
+
+def copy_to(fi, stream):
+    '''
+    Write the decompressed content of fi into stream (e.g. the standard input
+    of blast) from a thread, while the output of the program is being read
+    '''
+    stream = getattr(stream, 'buffer', stream)  # Binary, under a text stream
+
+    def copy():
+        try:
+            with open_file(fi, 'rb') as f:
+                shutil.copyfileobj(f, stream, 1 << 20)
+        except BrokenPipeError:
+            pass  # The program has stopped, its exit status tells why
+        finally:
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    return thread
 
 
 def input_type(b):
     '''
     return blast database type (prot or nucl)
+    Raise ValueError for any other program
     '''
     if b == 'blastp' or b == 'blastx':
         tp = 'prot'
@@ -82,14 +249,163 @@ def input_type(b):
         tp = 'nucl'
         return tp
     else:
-        sys.exit("Error: -b argument should only be 'blastp/blastn/blastx/tblastn'!")
+        raise ValueError("-b argument should only be 'blastp/blastn/blastx/tblastn'")
 
 
-def database_exist(db):
-    prot_databases = db + '.phr'
-    nucl_databases = db + '.nhr'
-    if os.path.exists(prot_databases) or os.path.exists(nucl_databases):
+def database_exist(db, fasta=None):
+    '''
+    Whether the database exists and, if its fasta is given, is newer than it
+    '''
+    for index in (db + '.phr', db + '.nhr'):
+        if os.path.exists(index):
+            return fasta is None or os.path.getmtime(index) >= os.path.getmtime(fasta)
+    return False
+
+
+def file_hash(fi):
+    h = hashlib.sha1()
+    with open(fi, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+LOCK_STALE = 24 * 3600  # A lock older than this (seconds) is left from a crashed job
+DB_IN_USE = []  # Shared locks of the cached databases used, held until the process exits
+
+
+def use_database(folder):
+    '''
+    Take a shared lock on the <database>.use file of a cached database,
+    so that no other job evicts it while this process may search it.
+    It blocks while another job is evicting the database.
+    '''
+    while True:
+        use = open(folder + '.use', 'a')
+        if not fcntl:
+            break
+        fcntl.flock(use, fcntl.LOCK_SH)
+        try:
+            # Locked the file eviction has not removed in the meantime
+            if os.fstat(use.fileno()).st_ino == os.stat(use.name).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        use.close()
+    DB_IN_USE.append(use)
+
+
+def evict_database(folder):
+    '''
+    Remove a cached database unless a job is using it, return whether it was removed
+    Without file locks (Windows), a database used within LOCK_STALE counts as in use.
+    '''
+    if not fcntl:
+        if time.time() - os.path.getmtime(folder) < LOCK_STALE:
+            return False
+        shutil.rmtree(folder, ignore_errors=True)
         return True
+    with open(folder + '.use', 'a') as use:
+        try:
+            fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False  # Shared lock of a job using it
+        shutil.rmtree(folder, ignore_errors=True)
+        os.remove(use.name)
+    return True
+
+
+def remove_stale_lock(lock):
+    '''
+    Remove the lock if it is older than LOCK_STALE. It is first renamed to
+    a name of this job, atomically, and put back if another job has replaced
+    it in the meantime by a fresh one, so two jobs finding the same stale
+    lock never remove the fresh lock of a third one.
+    '''
+    try:
+        stat = os.stat(lock)
+        if time.time() - stat.st_mtime <= LOCK_STALE:
+            return
+        taken = '{}.stale{}'.format(lock, os.getpid())
+        os.rename(lock, taken)
+    except OSError:
+        return  # Released or removed in the meantime
+    if os.stat(taken).st_ino == stat.st_ino:
+        os.remove(taken)
+    else:
+        os.rename(taken, lock)
+
+
+def cached_database(fasta, tp, cache_dir):
+    '''
+    Return the database of the fasta in the cache directory, keyed on the
+    SHA-1 of the fasta and the database type, making it first if needed.
+    The database is made in a temporary directory renamed once complete, so
+    it is never seen half-made, and a lock file created exclusively makes
+    concurrent jobs wait for the one making the same database.
+    The database is marked in use (use_database) before it is looked up.
+    '''
+    key = '{}_{}'.format(file_hash(fasta), tp)
+    folder = os.path.join(cache_dir, key)
+    db = os.path.join(folder, 'db')
+    lock = folder + '.lock'
+    os.makedirs(cache_dir, exist_ok=True)
+    use_database(folder)
+    while not os.path.isdir(folder):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            remove_stale_lock(lock)
+            print("Waiting for another job making the same database...")
+            time.sleep(10)
+            continue
+        tmp = '{}.tmp{}'.format(folder, os.getpid())
+        try:
+            os.close(fd)
+            if not os.path.isdir(folder):
+                shutil.rmtree(tmp, ignore_errors=True)
+                os.makedirs(tmp)
+                run_mkblastdb(fasta, os.path.join(tmp, 'db'), tp)
+                os.rename(tmp, folder)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)  # Left only if makeblastdb failed
+            try:
+                os.remove(lock)
+            except FileNotFoundError:
+                pass  # Taken for stale by another job
+    os.utime(folder)  # Most recently used
+    return db
+
+
+def evict_databases(cache_dir, max_gb, keep):
+    '''
+    Remove the least recently used databases of the cache directory
+    until they fit in max_gb, except this job's one (keep) and those
+    other jobs are using
+    '''
+    limit = max_gb * 1024 ** 3
+    entries = []
+    for name in os.listdir(cache_dir):
+        folder = os.path.join(cache_dir, name)
+        if not os.path.isdir(folder) or '.tmp' in name:
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+            entries.append((os.path.getmtime(folder), size, folder))
+        except FileNotFoundError:
+            continue  # Evicted by another job in the meantime
+    total = sum(size for _, size, _ in entries)
+    keep = os.path.abspath(keep)
+    for _, size, folder in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            if os.path.abspath(folder) == keep or not evict_database(folder):
+                continue
+        except FileNotFoundError:
+            continue
+        total -= size
+        print("Database cache: {} was evicted.".format(os.path.basename(folder)))
 
 
 def run_mkblastdb(fi, fo, tp):
@@ -97,146 +413,432 @@ def run_mkblastdb(fi, fo, tp):
     fi: input fasta file
     fo: output database name
     tp: prot or nucl
+    Raise RuntimeError if makeblastdb fails
     '''
+    compressed = compression(fi) is not None
     cmd_para = [
                 'makeblastdb',
-                '-in', fi,
+                '-in', '-' if compressed else fi,
                 "-dbtype", tp,
                 "-parse_seqids",
                 "-out", fo
                 ]
-    cmd = ' '.join(cmd_para)
-    try:
-        print("\n", 'Make Blast Database'.center(50, '*'))
-        print(cmd, "\n")
-        os.system(cmd)
-    except Exception as e:
-        raise e
-
-
-def run_blast(q, o, db, e, f, n, b):
+    if compressed:  # Decompressed into the standard input
+        cmd_para += ['-title', os.path.basename(fi)]
+    print("\n", 'Make Blast Database'.center(50, '*'))
+    print(' '.join(cmd_para), "\n")
+    process = subprocess.Popen(cmd_para, stdin=subprocess.PIPE if compressed else None)
+    if compressed:
+        copy_to(fi, process.stdin)
+    if process.wait():
+        raise RuntimeError('makeblastdb failed to build the database from {}'.format(fi))
+
+
+def run_blast(q, db, e, f, n, b):
     '''
     q: query
-    o: output
     db: database
     e: evalue
     f: outfmt
     n: num_threads
     b: blast program
+    Yield the output lines as blast writes them, so that they are
+    parsed on the fly without any intermediate file.
+    A compressed query is decompressed into the standard input of blast.
     '''
+    compressed = compression(q) is not None
     cmd_para = [
                 b,
-                '-query', q,
-                '-out', o,
+                '-query', '-' if compressed else q,
                 '-db', db,
                 '-evalue', str(e),
-                '-outfmt', f,
+                '-outfmt', f.strip('"\''),
                 '-num_threads', str(n)
                 ]
-    cmd = ' '.join(cmd_para)
-    try:
-        print("\n", 'BLAST Searching'.center(50, '*'))
-        print(cmd, "\n")
-        os.system(cmd)
-    except Exception as e:
-        raise e
+    print("\n", 'BLAST Searching'.center(50, '*'))
+    print(' '.join(cmd_para), "\n")
+    process = subprocess.Popen(cmd_para, stdout=subprocess.PIPE, universal_newlines=True,
+                               stdin=subprocess.PIPE if compressed else None)
+    if compressed:
+        copy_to(q, process.stdin)
+    for line in process.stdout:
+        yield line
+    process.stdout.close()
+    if process.wait():
+        raise RuntimeError('{} exited with status {}'.format(b, process.returncode))
+
+
+def run_blast_file(q, o, db, e, f, n, b):
+    '''
+    Run blast with the output written to o, return the query
+    '''
+    with open(o, 'w') as output:
+        output.writelines(run_blast(q, db, e, f, n, b))
+    return q
+
 
+def run_blast_file_star(para):
+    return run_blast_file(*para)
 
-def creat_dict(fa):
-    with open(fa, 'r') as f:
-        dict = defaultdict(str)
-        name = ''
+
+def split_query(q, k, prefix):
+    '''
+    Split the query fasta into at most k chunks of consecutive records
+    holding about the same number of residues, so that the chunks take
+    about the same time to search and their results keep the query order.
+    return the chunk file names
+    '''
+    total = 0
+    with open_file(q) as f:
+        for line in f:
+            if not line.startswith('>'):
+                total += len(line.strip())
+    chunks = []
+    residues = 0
+    out = None
+    with open_file(q) as f:
         for line in f:
             if line.startswith('>'):
-                name = line[1:-1].split()[0]
-                continue
-            dict[name] += line.strip()
-        return dict
+                # Start the next chunk once this one holds its share of residues
+                if out is None or (residues >= total * len(chunks) / k and len(chunks) < k):
+                    if out:
+                        out.close()
+                    chunks.append('{}.chunk{}.fa'.format(prefix, len(chunks)))
+                    out = open(chunks[-1], 'w')
+            else:
+                residues += len(line.strip())
+            if out:
+                out.write(line)
+    if out:
+        out.close()
+    return chunks
 
 
-def blast_Parser(fi, fo, header, idt, qc, ms, *dict):
+def run_blast_chunks(q, db, e, f, n, b, k, prefix):
     '''
-    fi: blast output (format as defined in this script)
-    fo: final output
-    dict: dictionary created from query fasta (used to extract hit sequences)
+    Search the query in k chunks at the same time, each with n // k threads.
+    Yield the output lines in the query order: those of every chunk as soon as
+    it and all the chunks before it are done, while the next ones still run.
+    The chunks and their outputs are removed even if a search fails.
     '''
-    seq_dict = {}  # initialize a dict to index query sequences
-    if dict:
-        seq_dict = dict[0]
-
-    with open(fi) as input, open(fo, 'w') as output:
-        output.write("\t".join(header) + "\n")
-        times = 0  # initialize the hit number
-        quer_last = ''  # initialize the hit sequence
-        for line in input.readlines():
-            items = line.strip().split("\t")
-            quer = items[0]
-            if quer == quer_last:
-                times += 1
-                if times > ms:
-                    continue
-            else:
-                quer_last = quer
-                times = 1
+    chunks = split_query(q, k, prefix)
+    threads = max(1, n // len(chunks)) if chunks else n
+    try:
+        with Pool(len(chunks) or 1) as pool:
+            jobs = [(chunk, chunk + '.out', db, e, f, threads, b) for chunk in chunks]
+            for chunk in pool.imap(run_blast_file_star, jobs):
+                with open(chunk + '.out', 'r') as fi:
+                    for line in fi:
+                        yield line
+                os.remove(chunk)
+                os.remove(chunk + '.out')
+    finally:
+        for chunk in chunks:
+            for fi in (chunk, chunk + '.out'):
+                if os.path.exists(fi):
+                    os.remove(fi)
+
+
+class FastaIndex:
+    '''
+    Sequences of a fasta file looked up through a faidx-style index
+    (<fasta>.fai: name, length, offset, line bases, line width), which is
+    built once and rebuilt only when the fasta is newer.
+    Blast reports the queries in the order of the fasta, so the index is
+    read forward along with the blast output instead of being loaded into
+    memory, and a sequence is only read from the fasta when it is asked for.
+    Offsets of a compressed fasta are those of its decompressed content,
+    which is read forward too, and only started over to go backward.
+    '''
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.fai = fasta + '.fai'
+        if not os.path.exists(self.fai) or os.path.getmtime(self.fai) < os.path.getmtime(fasta):
+            self.build()
+        self.index = open(self.fai, 'r')
+        self.seekable = compression(fasta) is None
+        self.seqs = open_file(fasta, 'rb')
+        self.pos = 0
+        self.last = (None, '')
+        self.offsets = None  # All offsets, loaded once a name is missing from the fasta
+
+    def build(self):
+        with open_file(self.fasta, 'rb') as f, open(self.fai, 'w') as fo:
+            pos = 0
+            record = None  # [name, length, offset, line bases, line width]
+            for line in f:
+                if line.startswith(b'>'):
+                    if record:
+                        fo.write('\t'.join(map(str, record)) + '\n')
+                    record = [line[1:].split()[0].decode(), 0, pos + len(line), 0, 0]
+                elif record:
+                    bases = len(line.rstrip())
+                    if not record[3]:
+                        record[3], record[4] = bases, len(line)
+                    record[1] += bases
+                pos += len(line)
+            if record:
+                fo.write('\t'.join(map(str, record)) + '\n')
+
+    def offset(self, name):
+        '''
+        Read the index forward to the name, starting over once if it is not ahead
+        Return None if the fasta has no such name. The offsets of all the names
+        are then loaded, so that other missing names are not searched for
+        through the whole index again.
+        '''
+        if self.offsets is None:
+            for _ in range(2):
+                for line in self.index:
+                    items = line.split('\t')
+                    if items[0] == name:
+                        return int(items[2])
+                self.index.seek(0)
+            self.offsets = {}
+            for line in self.index:
+                items = line.split('\t')
+                self.offsets[items[0]] = int(items[2])
+        return self.offsets.get(name)
+
+    def read_at(self, offset):
+        if self.seekable:
+            self.seqs.seek(offset)
+        else:
+            if offset < self.pos:
+                self.seqs.close()
+                self.seqs = open_file(self.fasta, 'rb')
+                self.pos = 0
+            while self.pos < offset:
+                self.pos += len(self.seqs.read(min(offset - self.pos, 1 << 20)))
+        seq = []
+        while True:
+            line = self.seqs.readline()
+            self.pos += len(line)
+            if not line or line.startswith(b'>'):
+                break
+            seq.append(line.strip())
+        return b''.join(seq).decode()
+
+    def __getitem__(self, name):
+        '''
+        Sequence of the name, '' if it is not in the fasta
+        '''
+        if name != self.last[0]:
+            offset = self.offset(name)
+            self.last = (name, '' if offset is None else self.read_at(offset))
+        return self.last[1]
+
+    def lookup(self, names):
+        '''
+        Yield the name and sequence of the names found in the fasta, in the
+        order of the fasta, reading the index once for all of them. For names
+        in any order, unlike the forward lookup of [].
+        '''
+        wanted = set(names)
+        offsets = {}
+        self.index.seek(0)
+        for line in self.index:
+            name, _, offset = line.split('\t', 3)[:3]
+            if name in wanted:
+                offsets[name] = int(offset)
+        for name in sorted(offsets, key=offsets.get):
+            yield name, self.read_at(offsets[name])
+
+    def close(self):
+        self.index.close()
+        self.seqs.close()
+
+
+def filter_hits(lines, idt, qc, ms, sc=0, br=0):
+    '''
+    lines: blast output lines (format as defined in this script)
+    Yield the columns of the first ms hits of every query reaching the
+    identity, query and subject coverage and bitscore ratio thresholds,
+    with the query coverage appended
+    '''
+    rows = (line.strip().split("\t") for line in lines)
+    for quer, group in itertools.groupby(rows, key=lambda items: items[0]):
+        group = list(group)
+        best = max(float(items[13]) for items in group)
+        for items in group[:ms]:
             qstart, qend, qlen = map(float, (items[6], items[7], items[10]))
             qcov = 100 * (qend - qstart) / qlen
             ident = float(items[2])
             if ident < idt or qcov < qc:
                 continue
+            if sc:
+                sstart, send, slen = map(float, (items[8], items[9], items[11]))
+                if 100 * abs(send - sstart) / slen < sc:
+                    continue
+            if br and float(items[13]) < br * best:
+                continue
             items.append(str(round(qcov, 1)))
-            if seq_dict:
-                qid = items[0]
-                items.append(seq_dict[qid])
-            output.write("\t".join(items) + "\n")
+            yield items
 
 
-def review_output(file):
-    with open(file, 'r+') as fi:
-        if len(fi.readlines()) == 1:
-            fi.seek(0)
-            fi.truncate()
+CHUNK_LINES = 1000000  # Lines of blast output filtered at once by the columnar parser
 
-def main():
-    tp = input_type(args.b)
 
-    if not args.o:
-        args.o = os.path.basename(args.q) + '_blast.out'
+def line_batches(lines, size=CHUNK_LINES):
+    '''
+    Group the lines into batches of about size lines, never splitting
+    the hits of a query between two batches
+    '''
+    batch = []
+    for line in lines:
+        if len(batch) >= size and line.split("\t", 1)[0] != batch[-1].split("\t", 1)[0]:
+            yield batch
+            batch = []
+        batch.append(line)
+    if batch:
+        yield batch
 
-    # Make blast database
-    if args.df:
-        database_file = os.path.join(os.getcwd(), args.df) + '.db'
-        if not database_exist(database_file):
-            print("Starting to make blast database...")
-            run_mkblastdb(args.df, database_file, tp)
-        args.db = database_file
-        print('DB: ', args.db)
 
-    # Storing temporary blast result
-    tempt_output = str(args.o) + '_blast.tmp'
+def filter_hits_columnar(lines, idt, qc, ms, sc=0, br=0):
+    '''
+    Same as filter_hits, reading the lines in large batches into pandas and
+    filtering them with vectorised operations.
+    Yield a DataFrame of the hits kept in every batch, whose columns are
+    the blast columns, as written by blast, and the query coverage
+    '''
+    import pandas as pd
+
+    for batch in line_batches(lines):
+        df = pd.read_csv(io.StringIO(''.join(batch)), sep="\t", header=None,
+                         dtype=str, keep_default_na=False, quoting=3)
+        num = df[list(range(2, 14))].astype('float64')
+        # Hits of the same query are consecutive
+        group = (df[0] != df[0].shift()).cumsum()
+        qcov = 100 * (num[7] - num[6]) / num[10]
+        keep = (df.groupby(group).cumcount() < ms) & (num[2] >= idt) & (qcov >= qc)
+        if sc:
+            keep &= 100 * (num[9] - num[8]).abs() / num[11] >= sc
+        if br:
+            keep &= num[13] >= br * num[13].groupby(group).transform('max')
+        kept = df[keep].copy()
+        kept[len(df.columns)] = [str(round(x, 1)) for x in qcov[keep]]
+        yield kept
+
+
+def blast_Parser(lines, fo, header, idt, qc, ms, *dict, sc=0, br=0, threads=1):
+    '''
+    lines: blast output lines (format as defined in this script)
+    fo: final output, compressed according to its extension (.gz or .zst)
+    dict: FastaIndex of the query fasta (used to extract hit sequences)
+    threads: threads of the output compression
+    The hits are filtered in batches with pandas if it is installed,
+    otherwise line by line.
+    The header is only written along with the first hit, so that the output
+    stays empty if no hit was found.
+    return the number of hits written
+    '''
+    seq_dict = {}  # initialize a dict to index query sequences
+    if dict:
+        seq_dict = dict[0]
+    try:
+        import pandas
+    except ImportError:
+        pandas = None
+
+    with open_file(fo, 'w', threads) as output:
+        written = 0
+        if pandas is None:
+            for items in filter_hits(lines, idt, qc, ms, sc, br):
+                if seq_dict:
+                    qid = items[0]
+                    items.append(seq_dict[qid])
+                if not written:
+                    output.write("\t".join(header) + "\n")
+                output.write("\t".join(items) + "\n")
+                written += 1
+            return written
+        for kept in filter_hits_columnar(lines, idt, qc, ms, sc, br):
+            if kept.empty:
+                continue
+            if seq_dict:
+                kept[len(kept.columns)] = [seq_dict[qid] for qid in kept[0]]
+            if not written:
+                output.write("\t".join(header) + "\n")
+            rows = kept[0].str.cat([kept[c] for c in kept.columns[1:]], sep="\t")
+            output.write("\n".join(rows) + "\n")
+            written += len(kept)
+        return written
 
-    # => Run blast program
-    run_blast(args.q, tempt_output, args.db, args.e, args.f, args.n, args.b)
 
-    # Creat dict from query fasta, in order to extract sequencs later
-    dict = creat_dict(args.q)
+def prepare_database(df, b, cache_dir=None, cache_size=0):
+    '''
+    df: fasta file to be used as database
+    b: blast program
+    cache_dir, cache_size: see --db_cache and --db_cache_size
+    Make the database of the fasta if needed, return its name
+    Raise ValueError for an unknown program, RuntimeError if makeblastdb fails
+    '''
+    tp = input_type(b)
+    if cache_dir:
+        db = cached_database(df, tp, cache_dir)
+        if cache_size:
+            evict_databases(cache_dir, cache_size, os.path.dirname(db))
+        return db
+    db = os.path.join(os.getcwd(), df) + '.db'
+    # Made again if the fasta has changed since
+    if not database_exist(db, df):
+        print("Starting to make blast database...")
+        run_mkblastdb(df, db, tp)
+    return db
+
+
+def blast_search(q, o, db, e=1e-5, ms=1, n=3, b='blastp', idt=0, qc=0,
+                 qseq=True, f=OUTFMT, k=1, sc=0, br=0):
+    '''
+    Search the query fasta q against the database db and write the hits
+    passing the filters to o, the arguments being those of the command line.
+    return the number of hits written
+    Raise RuntimeError if blast fails. No output is left behind on any error.
+    '''
+    # => Run blast program, its output being parsed as it comes
+    if k > 1:
+        lines = run_blast_chunks(q, db, e, f, n, b, k, o)
+    else:
+        lines = run_blast(q, db, e, f, n, b)
 
     # Parse blast output
-    header = [
-                'qid', 'sid', 'ident%', 'aln_len', 'miss',
-                'gap', 'qstart', 'qend', 'sstart', 'send',
-                'qlen', 'slen', 'evalue', 'bitscore', 'qcov%', 'qseq'
-            ]
-    # If the --no_qseq option was specified, there would be no qseq column.
-    if args.nq:
-        header.remove('qseq')
-        blast_Parser(tempt_output, args.o, header, args.idt, args.qc, args.ms)
-    else:
-        blast_Parser(tempt_output, args.o, header, args.idt, args.qc, args.ms, dict)
-    # Remove temp file
-    os.remove(tempt_output)
+    # If qseq is False (--no_qseq), there would be no qseq column.
+    try:
+        if not qseq:
+            header = [h for h in HEADER if h != 'qseq']
+            return blast_Parser(lines, o, header, idt, qc, ms, sc=sc, br=br, threads=n)
+        # Index the query fasta, in order to extract the sequences of the hits later
+        index = FastaIndex(q)
+        try:
+            return blast_Parser(lines, o, HEADER, idt, qc, ms, index, sc=sc, br=br, threads=n)
+        finally:
+            index.close()
+    except BaseException:
+        # Do not leave a truncated output behind
+        if os.path.exists(o):
+            os.remove(o)
+        raise
+
+
+def main(argv=None):
+    args = get_args(argv)
+
+    if not args.o:
+        args.o = os.path.basename(args.q) + '_blast.out'
+
+    # The library functions raise, only the command line exits
+    try:
+        input_type(args.b)
+
+        # Make blast database
+        if args.df:
+            args.db = prepare_database(args.df, args.b, args.dc, args.dcs)
+            print('DB: ', args.db)
 
-    # Clear the lonely header line if no hit was found
-    review_output(args.o)
+        blast_search(args.q, args.o, args.db, args.e, args.ms, args.n, args.b,
+                     args.idt, args.qc, not args.nq, args.f, args.k, args.sc, args.br)
+    except (RuntimeError, ValueError, OSError) as e:
+        sys.exit("Error: {}!".format(e))
 
     print("\n", 'OUTPUT'.center(50, '*'))
     print("Output File: {0}".format(args.o))
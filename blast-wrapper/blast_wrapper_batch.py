@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+"""
+Search many query files against one database *in batch mode*,
+with the same filters and output as blast_wrapper.py
+
+Required: BLAST+ installed in $PATH, blast_wrapper.py in the same directory
+
+Usage:
+
+## Every *.faa file of a directory:
+$ python blast_wrapper_batch.py -i query_dir -df database.faa -o output_dir
+
+## Query files listed in a manifest, one path per line, 8 searches at the same time:
+$ python blast_wrapper_batch.py -i manifest.txt -db blast+_database -o output_dir -n 32 -j 8
+
+The database is made (or found in --db_cache) once, then all the queries are
+searched against it by a pool of -j workers, each blast getting -n/-j threads.
+Results are written to output_dir/<query file>_blast.out
+"""
+
+import os
+import sys
+import glob
+import argparse
+from multiprocessing import Pool
+
+from blast_wrapper import OUTFMT, input_type, prepare_database, blast_search
+
+__author__ = "Heyu Lin"
+__contact__ = "heyu.lin(AT)student.unimelb.edu.au"
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', metavar='query_dir_or_manifest', dest='i',
+                        type=str, required=True,
+                        help='directory containing the query files, or a file listing them one per line')
+    parser.add_argument('-x', '--suffix', metavar='suffix', dest='x',
+                        type=str, default='.faa',
+                        help='suffix of the query files in the input directory (default=.faa)')
+    parser.add_argument('-o', '--output', metavar='output_dir', dest='o',
+                        type=str, required=True,
+                        help='output files will be produced in this directory')
+    parser.add_argument('-df', '--database_fasta', metavar='database_fasta',
+                        dest='df', type=str,
+                        help='fasta file to be used as database')
+    parser.add_argument('-db', '--database', metavar='database',
+                        dest='db', type=str,
+                        help='blast database which has already been made')
+    parser.add_argument('--db_cache', metavar='cache_directory',
+                        dest='dc', type=str,
+                        help='directory where databases made from -df are cached by content')
+    parser.add_argument('--db_cache_size', metavar='size_in_GB',
+                        dest='dcs', type=float, default=0,
+                        help='disk budget of --db_cache (default=0, unlimited)')
+    parser.add_argument('-e', '--evalue', metavar='max_e-value', dest='e',
+                        type=float, default=1e-5,
+                        help='threshod e-value for blast (default=1e-5)')
+    parser.add_argument('-ms', '--max_target_seqs', metavar='num_sequences',
+                        dest='ms', type=int, default=1,
+                        help='specify the max_number of target seqs for hits per query (default=1)')
+    parser.add_argument('-n', '--num_threads', metavar='num_cpu',
+                        dest='n', type=int, default=3,
+                        help='total number of threads, shared among the concurrent searches (default=3)')
+    parser.add_argument('-j', '--jobs', metavar='num_jobs',
+                        dest='j', type=int, default=1,
+                        help='number of query files searched at the same time (default=1)')
+    parser.add_argument('-b', '--blast_program', metavar='blast+ program',
+                        dest='b', type=str, default='blastp',
+                        help='specify the blast program (default=blastp)')
+    parser.add_argument('-id', '--identity', metavar='identity_threshold',
+                        dest='idt', type=float, default=0,
+                        help='specify the threshold of identity (default=0)')
+    parser.add_argument('-qc', '--qcov', metavar='coverage_threshold',
+                        dest='qc', type=float, default=0,
+                        help='specify the threshold of query coverage (default=0)')
+    parser.add_argument('-sc', '--scov', metavar='coverage_threshold',
+                        dest='sc', type=float, default=0,
+                        help='specify the threshold of subject coverage (default=0)')
+    parser.add_argument('-br', '--bitscore_ratio', metavar='ratio',
+                        dest='br', type=float, default=0,
+                        help='only keep hits whose bitscore is at least this ratio (0-1) '
+                        'of the best bitscore of their query (default=0)')
+    parser.add_argument('--no_qseq', dest='nq', action='store_true', default=False,
+                        help='no query sequences will be showed if this argument is added')
+    return parser.parse_args(argv)
+
+
+def query_files(i, suffix):
+    '''
+    i: directory containing the query files, or manifest listing them
+    Paths in a manifest are relative to the manifest itself
+    '''
+    if os.path.isdir(i):
+        return sorted(glob.glob(os.path.join(i, '*' + suffix)))
+    queries = []
+    with open(i, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                queries.append(os.path.join(os.path.dirname(i), line))
+    return queries
+
+
+def search_job(para):
+    '''
+    Run in a worker process, return the query along with
+    its number of hits, or the error message if it failed,
+    so that one failed query does not stop the batch
+    '''
+    q = para[0]
+    try:
+        return q, blast_search(*para)
+    except Exception as e:
+        return q, str(e) or type(e).__name__
+
+
+def main(argv=None):
+    args = get_args(argv)
+    try:
+        input_type(args.b)
+    except ValueError as e:
+        sys.exit("Error: {}!".format(e))
+    queries = query_files(args.i, args.x)
+    if not queries:
+        sys.exit("Error: no query file was found in {}!".format(args.i))
+    print(len(queries), 'query files have been read.')
+    os.makedirs(args.o, exist_ok=True)
+
+    # Make the database once for all the queries
+    if args.df:
+        try:
+            args.db = prepare_database(args.df, args.b, args.dc, args.dcs)
+        except (RuntimeError, OSError) as e:
+            sys.exit("Error: {}!".format(e))
+    if not args.db:
+        sys.exit("Error: -df or -db is required!")
+    print('DB: ', args.db)
+
+    num_jobs = max(1, min(args.j, len(queries)))
+    threads = max(1, args.n // num_jobs)
+    jobs = [(q, os.path.join(args.o, os.path.basename(q) + '_blast.out'), args.db,
+             args.e, args.ms, threads, args.b, args.idt, args.qc, not args.nq, OUTFMT, 1,
+             args.sc, args.br)
+            for q in queries]
+    failed = []
+    with Pool(num_jobs) as pool:
+        for q, result in pool.imap_unordered(search_job, jobs):
+            if isinstance(result, str):
+                failed.append(q)
+                print("Error: {}: {}".format(q, result))
+            else:
+                print("{}: {} hits".format(q, result))
+
+    print("\n", 'OUTPUT'.center(50, '*'))
+    print("Output Directory: {0}".format(args.o))
+    if failed:
+        sys.exit("Error: {} of {} query files failed!".format(len(failed), len(queries)))
+
+
+if __name__ == '__main__':
+    main()
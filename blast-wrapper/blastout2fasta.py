@@ -5,18 +5,164 @@ Used to convert the output from blast_wrapper.py to fasta format
 
 Usage:
 $ python3 blastout2fasta.py blast.out > blast_out.fa
+
+## Write to a file, 60 residues per line:
+$ python3 blastout2fasta.py blast.out -o blast_out.fa -w 60
+
+## Sequences of the subjects (hit sequences of the database) instead,
+## from the database fasta or from the blast database:
+$ python3 blastout2fasta.py blast.out -s -df database.faa > subjects.fa
+$ python3 blastout2fasta.py blast.out -s -db database.faa.db > subjects.fa
+
+Every sequence is written once, even if it has several hits.
+Compressed inputs (gzip or zstd) are read as they are, and the output is
+compressed according to its extension (.gz or .zst).
 """
 
+import os
 import sys
-import textwrap
+import argparse
+import subprocess
+import tempfile
+
+from blast_wrapper import open_file, FastaIndex
 
 __author__ = "Heyu Lin"
 __contact__ = "heyu.lin(AT)student.unimelb.edu.au"
 
-in_file = sys.argv[1]
-with open(in_file, 'r') as fi:
-    for line in fi.readlines():
-        fields = line.strip().split('\t')
-        if fields[0] != 'qid':
-            print('>{header}'.format(header=fields[0]))
-            print(textwrap.fill(fields[15], 80))
+BUFFER_RECORDS = 10000  # Records written at once
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('i', metavar='blast_out', type=str,
+                        help='output of blast_wrapper.py')
+    parser.add_argument('-o', '--output', metavar='output_fasta', dest='o',
+                        type=str, default=None,
+                        help='output fasta file (default: standard output)')
+    parser.add_argument('-w', '--width', metavar='line_width', dest='w',
+                        type=int, default=80,
+                        help='number of residues per line, 0 for one line per sequence (default=80)')
+    parser.add_argument('-s', '--subject', dest='s', action='store_true', default=False,
+                        help='write the subject sequences instead of the query ones, '
+                        'taken from -df or -db')
+    parser.add_argument('-df', '--database_fasta', metavar='database_fasta', dest='df',
+                        type=str, default=None,
+                        help='fasta file the sequences are taken from, e.g. the database fasta with -s')
+    parser.add_argument('-db', '--database', metavar='database', dest='db',
+                        type=str, default=None,
+                        help='blast database the subject sequences are taken from with blastdbcmd')
+    args = parser.parse_args(argv)
+    if args.s and not (args.df or args.db):
+        parser.error('-s requires -df or -db')
+    return args
+
+
+def wrap(seq, width):
+    '''
+    Fixed-width line breaking
+    '''
+    if not width:
+        return seq + '\n'
+    return ''.join(seq[i:i + width] + '\n' for i in range(0, len(seq), width))
+
+
+def hit_ids(fi, column):
+    '''
+    Return the IDs of the given column (0: query, 1: subject), each once,
+    in the order of their first hit
+    '''
+    seen = {}
+    with open_file(fi) as f:
+        for line in f:
+            if line.startswith('qid\t'):
+                continue
+            seen.setdefault(line.split('\t', 2)[column], None)
+    return list(seen)
+
+
+def qseq_records(fi):
+    '''
+    Yield the ID and sequence of every query from the qseq column,
+    streaming the output and skipping the next hits of a query
+    '''
+    seen = set()
+    with open_file(fi) as f:
+        for line in f:
+            if line.startswith('qid\t'):
+                continue
+            qid, rest = line.split('\t', 1)
+            if qid in seen:
+                continue
+            fields = rest.rstrip('\n').split('\t')
+            if len(fields) < 15:
+                sys.exit("Error: {} has no qseq column (--no_qseq), use -df query.faa instead!".format(fi))
+            seen.add(qid)
+            yield qid, fields[14]
+
+
+def fasta_records(fasta, ids):
+    '''
+    Yield the ID and sequence of the IDs from the fasta, through its index
+    '''
+    index = FastaIndex(fasta)
+    try:
+        for record in index.lookup(ids):
+            yield record
+    finally:
+        index.close()
+
+
+def blastdb_records(db, ids):
+    '''
+    Yield the ID and sequence of the IDs from the blast database,
+    as blastdbcmd writes them
+    '''
+    with tempfile.NamedTemporaryFile('w', suffix='.ids', delete=False) as f:
+        f.write('\n'.join(ids) + '\n')
+    try:
+        cmd_para = ['blastdbcmd', '-db', db, '-entry_batch', f.name, '-outfmt', '%a\t%s']
+        process = subprocess.Popen(cmd_para, stdout=subprocess.PIPE, universal_newlines=True)
+        for line in process.stdout:
+            name, seq = line.rstrip('\n').split('\t')
+            yield name, seq
+        process.stdout.close()
+        if process.wait():
+            sys.exit("Error: blastdbcmd exited with status {}!".format(process.returncode))
+    finally:
+        os.remove(f.name)
+
+
+def write_fasta(records, out, width):
+    '''
+    Write the records, buffering BUFFER_RECORDS at a time
+    '''
+    buf = []
+    for name, seq in records:
+        buf.append('>' + name + '\n' + wrap(seq, width))
+        if len(buf) >= BUFFER_RECORDS:
+            out.write(''.join(buf))
+            buf = []
+    out.write(''.join(buf))
+
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.s or args.df:
+        ids = hit_ids(args.i, 1 if args.s else 0)
+        if args.df:
+            records = fasta_records(args.df, ids)
+        else:
+            records = blastdb_records(args.db, ids)
+    else:
+        records = qseq_records(args.i)
+    out = open_file(args.o, 'w') if args.o else sys.stdout
+    try:
+        write_fasta(records, out, args.w)
+    finally:
+        if args.o:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,21 +15,36 @@ You could choose to remove 'idmapping.dat.gz' now.
 Step2: Retrieve K numbers according to the UniProtKB IDs of proteins
 $ python3 gbk2kegg.py -i input.gbk -d idmapping_KO.tab.gz -o output.txt
 
-This script will produce a json format database in the same folder of
-idmapping_KO.tab.gz for reuse, which may speed up the program when
-running next time.
+## One-off run, reading the database once without building the index:
+$ python3 gbk2kegg.py -i input.gbk -d idmapping_KO.tab.gz -o output.txt -s
+
+The first run sorts the database into a binary index (idmapping_KO.tab.gz.idx)
+in the same folder of idmapping_KO.tab.gz. Following runs open it instantly
+and only read the few pages needed to look up each UniProtKB ID.
+The index is built again whenever idmapping_KO.tab.gz is newer.
+With -s, the UniProtKB IDs of the gbk file(s) are collected first and
+only their K numbers are kept while reading the database once.
 """
 
 import os
 import re
 import gzip
+import mmap
+import heapq
+import shutil
+import struct
+import bisect
+import tempfile
 import curses
 import argparse
-import json
 
 __author__ = "Heyu Lin"
 __contact__ = "heyu.lin(AT)student.unimelb.edu.au"
 
+INDEX_MAGIC = b'P2KIDX1\n'
+INDEX_HEADER = struct.Struct('<8sHHQ')  # magic, key width, KO width, number of records
+RUN_RECORDS = 2000000  # Records sorted in memory at once when building the index
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input', metavar='input_gbk', dest='i',
                     type=str, required=True)
@@ -38,6 +53,9 @@ parser.add_argument('-o', '--output', metavar='output', dest='o',
 parser.add_argument('-d', '--data', metavar='idmapping.dat.gz',
                     dest='d', type=str,
                     help='UniProtKB cross-references database')
+parser.add_argument('-s', '--stream', dest='s', action='store_true', default=False,
+                    help='read the database once keeping only the UniProtKB IDs of the gbk file, '
+                    'instead of building or using the index')
 args = parser.parse_args()
 
 
@@ -69,24 +87,142 @@ def gbk_parser(gbk):
     return arr
 
 
-def dict_initialize(gzfile):
+def sorted_runs(gzfile, tmp_dir):
+    """
+    Split the database into runs of RUN_RECORDS 'UniProtKB\\tline number\\tKO' lines,
+    each sorted in memory and written to tmp_dir
+    The zero-padded line number keeps the KOs of an ID in the database order
+    Return the run files along with the widest UniProtKB ID and KO
+    """
+    runs = []
+    key_width = ko_width = num = 0
+    buf = []
+
+    def flush():
+        buf.sort()
+        run = os.path.join(tmp_dir, 'run{}'.format(len(runs)))
+        with open(run, 'w') as fo:
+            fo.writelines(buf)
+        runs.append(run)
+        del buf[:]
+
+    with gzip.open(gzfile, 'rt') as fi:
+        for line in fi:
+            fields = line.strip().split('\t')
+            if len(fields) < 2:
+                continue
+            key_width = max(key_width, len(fields[0]))
+            ko_width = max(ko_width, len(fields[1]))
+            # '\t' sorts before any character of an ID, so the lines sort as their IDs
+            buf.append('{}\t{:012d}\t{}\n'.format(fields[0], num, fields[1]))
+            num += 1
+            if len(buf) >= RUN_RECORDS:
+                flush()
+    if buf or not runs:
+        flush()
+    return runs, key_width, ko_width
+
+
+def index_build(gzfile, idx_file):
+    """
+    Sort the database on disk (external merge sort) into fixed-width records:
+    the UniProtKB ID and the KO, both padded with NUL bytes
+    The index is written to a temporary file first, then renamed
+    """
+    out_dir = os.path.dirname(os.path.abspath(idx_file))
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
+    try:
+        runs, key_width, ko_width = sorted_runs(gzfile, tmp_dir)
+        handles = [open(run) for run in runs]
+        tmp_idx = os.path.join(tmp_dir, 'index')
+        num = 0
+        with open(tmp_idx, 'wb') as fo:
+            fo.write(INDEX_HEADER.pack(INDEX_MAGIC, key_width, ko_width, 0))
+            for line in heapq.merge(*handles):
+                key, _, ko = line.rstrip('\n').split('\t')
+                fo.write(key.encode().ljust(key_width, b'\0') + ko.encode().ljust(ko_width, b'\0'))
+                num += 1
+            fo.seek(0)
+            fo.write(INDEX_HEADER.pack(INDEX_MAGIC, key_width, ko_width, num))
+        for handle in handles:
+            handle.close()
+        os.replace(tmp_idx, idx_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class KOIndex(object):
+    """
+    Read-only view of the sorted index, memory-mapped
+    get() binary searches the UniProtKB IDs like dict.get(),
+    so only the pages holding the searched records are read
+    """
+
+    def __init__(self, idx_file):
+        self.fh = open(idx_file, 'rb')
+        magic, self.key_width, self.ko_width, self.num = \
+            INDEX_HEADER.unpack(self.fh.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError('{} is not a KO index'.format(idx_file))
+        self.size = self.key_width + self.ko_width
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if self.num else b''
+
+    def __len__(self):
+        return self.num
+
+    def __getitem__(self, i):
+        # The padded UniProtKB ID of record i, for bisect
+        start = INDEX_HEADER.size + i * self.size
+        return self.mm[start:start + self.key_width]
+
+    def get(self, key, default=None):
+        key = key.encode()
+        if len(key) > self.key_width:
+            return default
+        key = key.ljust(self.key_width, b'\0')
+        i = bisect.bisect_left(self, key)
+        kos = []
+        while i < self.num and self[i] == key:
+            start = INDEX_HEADER.size + i * self.size + self.key_width
+            kos.append(self.mm[start:start + self.ko_width].rstrip(b'\0').decode())
+            i += 1
+        return kos if kos else default
+
+    def close(self):
+        if self.num:
+            self.mm.close()
+        self.fh.close()
+
+
+def index_load(gzfile):
+    """
+    Open the index of the database, built beforehand if
+    it does not exist or is older than the database
+    """
+    idx_file = gzfile + '.idx'
+    if not os.path.exists(idx_file) or os.path.getmtime(idx_file) < os.path.getmtime(gzfile):
+        print("Building the index of {}, only needed once...".format(gzfile))
+        index_build(gzfile, idx_file)
+    return KOIndex(idx_file)
+
+
+def dict_stream(gzfile, arrs):
+    """
+    Read the database once, keeping only the UniProtKB IDs found in
+    the gbk files (arrs: outputs of gbk_parser), without any index
+    Memory is bounded by the number of IDs, not by the database size
+    """
+    keys = set(cds[1].encode() for arr in arrs for cds in arr if cds[1])
     dict = {}
     with gzip.open(gzfile) as fi:
-        for line in fi.readlines():
-            fields = line.decode('utf-8').strip().split('\t')
-            if fields[0] not in dict:
-                dict[fields[0]] = [fields[1]]
-            else:
-                dict[fields[0]].append(fields[1])
+        for line in fi:
+            key = line.split(b'\t', 1)[0].strip()
+            if key in keys:
+                fields = line.decode('utf-8').strip().split('\t')
+                dict.setdefault(fields[0], []).append(fields[1])
     return dict
 
 
-def dict_load(json_file):
-    with open(json_file, 'r') as f:
-        r = json.load(f)
-    return r
-
-
 def retrieve_KO(arr, dict):
     """
     arr = [
@@ -123,11 +259,6 @@ def retrieve_KO(arr, dict):
     return new_arr
 
 
-def write_json(content, outfile):
-    with open(outfile, 'w') as fo:
-        json.dump(content, fo)
-
-
 def output(arr, outfile):
     """
     arr = [
@@ -146,12 +277,11 @@ def output(arr, outfile):
 
 
 def main():
-    if os.path.exists(args.d + '.json'):
-        db_dict = dict_load(args.d + '.json')
-    else:
-        db_dict = dict_initialize(args.d)
-        write_json(db_dict, args.d + '.json')
     mapping_array = gbk_parser(args.i)
+    if args.s:
+        db_dict = dict_stream(args.d, [mapping_array])
+    else:
+        db_dict = index_load(args.d)
     final_arr = retrieve_KO(mapping_array, db_dict)
     output(final_arr, args.o)
 